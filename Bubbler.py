@@ -85,40 +85,90 @@ Alternative play mode ideas:
     Place a chair with a zoomed in view of just a face.
 
 '''  
-import cv2, sys, logging, Queue, random, time, numpy, optparse
+import cv2, sys, logging, random, time, numpy, optparse
 from PyQt4.QtGui import *
 from PyQt4.QtCore import *
 
-import video
-from common import draw_str, small_draw_str, big_draw_str
+import video, capture, collision, particles, compositor, scheduler, profiler
+import motion, skeleton, pipeline, offload, framebus, recorder, replay
+import sprites, display, glrender, profiles, governor, frameclock
+from common import clock
 
+# Sizes, speeds and budgets, see profiles.py
 IMG_WIDTH  = 800
 IMG_HEIGHT = 600
-DEBUG      = False 
+PIXEL_SCALE = 1.0
+CAPTURE_SIZE = (800, 600)
+CAMERA_FPS = None
+BLUR_KERNEL = 20
+BUBBLE_SPEED = 1/75.0
+GOOD_RADIUS = 20
+BAD_RADIUS = 10
+BAD_RADIUS_JUMP = 10
+MAX_BUBBLES = 10
+MAX_MESS_BUBBLES = 50
+CAMERA = 1
+SOURCE = None
+DEBUG      = False
 VIDEO_ONLY = False
+THREADED_CAPTURE = True
+PROFILE_LOG = None
+MOTION_ENGINE = 'static'
+MOTION_SCALE = 1
+PIPELINE_DEPTH = 0
+OFFLOAD_PROCESSES = 0
+FRAME_BUS = None
+RECORD = None
+RECORD_MASK = False
+RECORD_POLICY = recorder.DROP
+RECORD_FPS = None
+SESSION = None
+SESSION_FORMAT = 'jpg'
+SKELETON_METHOD = 'morph'
+SKELETON_BUDGET_MS = None
+MASK_CHANGE_FRACTION = 0.01
+MASK_REFRESH_FRAMES = 30
+KIOSK = False
+PROCESSED_FPS = None
+LIVE_FPS = None
+RENDERER = 'software'
+TARGET_FPS = None
+
+def bubble_increment(fraction=1.0):
+    ''' How far a falling bubble (or fraction of its speed) moves per frame. '''
+    return max(int(round(IMG_HEIGHT * BUBBLE_SPEED * fraction)), 1)
+
+def scaled(pixels):
+    ''' A size in pixels of the classic 600 pixel high frame, at this one. '''
+    return max(int(round(pixels * PIXEL_SCALE)), 1)
+
 
 class ReferenceMAT(object):
-    def __init__(self):
+    def __init__(self, in_motion_engine):
         logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
             level=logging.DEBUG)
         self.log = logging.getLogger()
         self.reference_color = None
         self.reference_gray  = None
         self.preproc_enabled = False
+        self.motion_engine = in_motion_engine
 
     def pre_process(self, in_mat, in_motion_mat):
         self.log.info("New reference acquisition")
         self.reference_color = in_mat.copy()
         self.reference_gray  = cv2.cvtColor(self.reference_color, 
                                             cv2.COLOR_BGR2GRAY)
+        self.motion_engine.reset(self.reference_color)
         return in_mat, in_motion_mat
 
 
 class DebugInfo(object):
-    def __init__(self):
+    def __init__(self, in_sprites):
+        self.sprites = in_sprites
         self.last_time = cv2.getTickCount()
         self.tick_frequency = cv2.getTickFrequency()
         self.enabled = True
+        self.draws_on_mask = True
         
     def opencv_fps(self):
         now = cv2.getTickCount()
@@ -127,19 +177,37 @@ class DebugInfo(object):
         return 1/dt
 
     def post_process(self, in_mat, in_motion_mat):
-        result = big_draw_str(in_motion_mat, (IMG_WIDTH-180,50), 
-                'FPS: %0.0f' % self.opencv_fps())
+        # Keep timing every frame, even when the Processed window skips it
+        fps = self.opencv_fps()
+        if in_motion_mat is None: return
+        self.sprites.text(in_motion_mat, (IMG_WIDTH-scaled(180),scaled(50)),
+                'FPS: %0.0f' % fps, 2.5 * PIXEL_SCALE,
+                (255,255,255), scaled(10))
 
 
 class GameControl(object):
-    def __init__(self):
+    def __init__(self, in_sprites, in_timers):
         self.enabled = True
+        # The HUD strings are rendered once per value, see sprites.py
+        self.sprites = in_sprites
+        # The countdown and the game clock run on frame time, see frameclock.py
+        self.timers = in_timers
 
         class signalObject(QObject):
              start_game = pyqtSignal()
              stop_game  = pyqtSignal()
         self.game_sig = signalObject()
 
+        # Made once: a replaced timer would still fire, a dropped QTimer
+        # didn't
+        self.delay_start_timer = frameclock.FrameTimer(self.timers)
+        self.delay_start_timer.setSingleShot(True)
+        self.delay_start_timer.timeout.connect(self.delay_start)
+
+        self.game_timer = frameclock.FrameTimer(self.timers)
+        self.game_timer.setSingleShot(True)
+        self.game_timer.timeout.connect(self.time_update)
+
         self.reset_game()
 
         # On initial startup, have a shorter delay
@@ -154,17 +222,17 @@ class GameControl(object):
         self.score = 0
         self.high_score = 0
         self.score_interval = 100
-        self.good_radius = 20
-        self.good_increment = IMG_HEIGHT / 48  
+        self.good_radius = GOOD_RADIUS
+        self.good_increment = bubble_increment()
 
-        self.base_radius = 10
+        self.base_radius = BAD_RADIUS
         self.bad_radius = self.base_radius
-        self.bad_radius_jump = 10
+        self.bad_radius_jump = BAD_RADIUS_JUMP
         self.bad_exists = 0
-        self.bad_increment = IMG_HEIGHT / 48 
+        self.bad_increment = bubble_increment()
         self.bad_multi = 10
         self.score_level = 100
-        self.max_bubbles = 10
+        self.max_bubbles = MAX_BUBBLES
 
         self.popped_increment = 3
         self.popped_radius = 2
@@ -189,15 +257,8 @@ class GameControl(object):
             self.game_total_prestart_time = 2
         self.prestart_time = self.game_total_prestart_time
 
-        self.delay_start_timer = QTimer()
-        self.delay_start_timer.setSingleShot(True)
-        self.delay_start_timer.timeout.connect(self.delay_start)
         self.delay_start_timer.start(0)
 
-        self.game_timer = QTimer()
-        self.game_timer.setSingleShot(True)
-        self.game_timer.timeout.connect(self.time_update)
-
     def delay_start(self):
         self.prestart_time -= 1
         if self.prestart_time >= 0:
@@ -227,87 +288,79 @@ class GameControl(object):
 
     def post_process(self, in_mat, in_motion_mat):
         if self.prestart_time >= 0:
-            result = draw_str(in_mat, (self.prestart_time_x, self.prestart_time_y),
+            self.sprites.text(in_mat, (self.prestart_time_x, self.prestart_time_y),
                     'Game starts in: %0d' % self.prestart_time)
 
         else:
-            result = draw_str(in_mat, (self.time_x, self.time_y),
+            self.sprites.text(in_mat, (self.time_x, self.time_y),
                     'Time left: %0d' % self.time_left)
 
-            result = draw_str(in_mat, ((IMG_WIDTH/2)-30,IMG_HEIGHT-10), 
+            self.sprites.text(in_mat, ((IMG_WIDTH/2)-30,IMG_HEIGHT-10),
                     'Score: %0d' % self.score)
     
 
 class MessBubbles(object):
-    def __init__(self, in_x, in_y):
+    def __init__(self, in_x, in_y, in_compositor, in_count=None):
         self.enabled = True
+        self.compositor = in_compositor
 
         class doneObj(QObject):
             done_animation = pyqtSignal(int, int, 'QString')
         self.done_sig = doneObj()
 
-        build_item = Bubble()
-        build_item.x = in_x
-        build_item.y = in_y
-
-        self.max_mess_bubbles = 50
-        self.game_popped_increment = 5
-        self.game_popped_radius = 5
-        self.game_popped_bubbles = []
-
-        self.add_popped_bubbles(build_item)
-
-    def add_popped_bubbles(self, in_item):
-        for i in range(self.max_mess_bubbles):
-            xr = (IMG_WIDTH/8)
-            if i > xr:
-                new_x = in_item.x + (random.randrange(1, xr, 1))
-            else:
-                new_x = in_item.x - (random.randrange(1, xr, 1))
-                #new_y = in_item.y - (random.randrange(10, 20, 1))
-
-            yr = 5 
-            new_y = in_item.y + (random.randrange(1, yr, 1))
-            nb = Bubble(increment=self.game_popped_increment, 
-                        radius=self.game_popped_radius,
-                        color=(0,255,0),
-                        start_x = new_x, start_y = new_y)
-            #self.log.info("Popped: " + str(nb.x))
-            self.game_popped_bubbles.append(nb)
-
-    def game_process(self, in_mat, in_motion_mat):
-        at_least_one = False
-        overlay = in_mat.copy()
-
-        for item in self.game_popped_bubbles:
-            # If bubble has moved to the top of the screen starting
-            # area, consider the animation done, and don't draw it
-            if item.y >= 0:
-                
-                result = item.local_pop_check(in_motion_mat)
-                item.auto_fade()
-
-                cv2.circle(overlay, (item.x, item.y), item.radius, item.color,
-                        thickness=-1, lineType=cv2.CV_AA)
-
-                at_least_one = True
-                if not result:
-                    item.animate()
-
-        # From:
-        # http://bistr-o-mathik.org/2012/06/13/simple-transparency-in-opencv/
-        opacity = item.opacity
-        cv2.addWeighted( overlay, opacity, in_mat, 1-opacity, 0, in_mat)
+        self.max_mess_bubbles = MAX_MESS_BUBBLES
+        if in_count is not None:
+            self.max_mess_bubbles = in_count
+        # 5 pixels and 5 pixels per frame in the classic profile
+        self.game_popped_increment = bubble_increment(5 / 8.0)
+        self.game_popped_radius = scaled(5)
+        self.game_popped_color = (0,255,0)
+        self.game_popped_bubbles = particles.ParticleStore(
+                                        self.max_mess_bubbles,
+                                        IMG_WIDTH, IMG_HEIGHT,
+                                        radius=self.game_popped_radius,
+                                        increment=self.game_popped_increment)
+
+        self.add_popped_bubbles(in_x, in_y)
+
+    def add_popped_bubbles(self, in_x, in_y):
+        count = self.max_mess_bubbles
+        xr = (IMG_WIDTH/8)
+        x_offset = numpy.random.randint(1, xr, count)
+        x_offset[:xr+1] *= -1
+        y_offset = numpy.random.randint(1, 5, count)
+        self.game_popped_bubbles.place(in_x + x_offset, in_y + y_offset)
+
+    def game_process(self, in_mat, in_collision):
+        store = self.game_popped_bubbles
+
+        # If bubble has moved to the top of the screen starting area, consider
+        # the animation done, and don't draw it
+        active = store.visible()
+        results = in_collision.hits(store.x, store.y, store.radius)
+
+        store.auto_fade(active)
+
+        # The translucent drops are blended into the frame by the shared
+        # compositor once every effect has drawn
+        opacity = max(float(store.opacity.max()), 0)
+        self.compositor.circles(store.x[active], store.y[active],
+                                store.radius[active], self.game_popped_color,
+                                opacity)
+
+        # Bubbles stick to the actor they hit, the rest keep falling
+        store.animate(active & ~results)
 
         # If not a single bubble left, set enabled to false to remove it from
-        # the processing queue
-        if not at_least_one:
+        # the game stage
+        if not active.any():
             self.enabled = False
-            self.done_sig.done_animation.emit(item.x, item.y, "mess done")
+            last = store.record(-1)
+            self.done_sig.done_animation.emit(last.x, last.y, "mess done")
 
 
 class GroupBubbles(object):
-    def __init__(self, count=10):
+    def __init__(self, in_compositor, count=10, radius=None, increment=None):
         logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
             level=logging.DEBUG)
         self.log = logging.getLogger()
@@ -317,27 +370,36 @@ class GroupBubbles(object):
             popped = pyqtSignal(int, int, 'QString')
         self.pop_sig = popObj()
         
+        self.compositor = in_compositor
         self.count = count
-        self.bubbles = []
-        for i in range(self.count):
-            self.bubbles.append(  Bubble() )
+        self.color = (255,0,0)
+        if radius is None:
+            radius = GOOD_RADIUS
+        if increment is None:
+            increment = bubble_increment()
+        self.bubbles = particles.ParticleStore(self.count, IMG_WIDTH,
+                                               IMG_HEIGHT, radius=radius,
+                                               increment=increment)
 
 
-    def game_process(self, in_mat, in_motion_mat):
-        for item in self.bubbles:
-            result = item.local_pop_check(in_motion_mat)
-            if result:
-                self.pop_sig.popped.emit(item.x, item.y, "popped")
-                item.reset_position()
+    def game_process(self, in_mat, in_collision):
+        store = self.bubbles
+        results = in_collision.hits(store.x, store.y, store.radius)
 
-            else:
-                item.animate()
-                cv2.circle(in_mat, (item.x, item.y), item.radius, item.color,
-                        thickness=-1, lineType=cv2.CV_AA)
+        for index in numpy.flatnonzero(results):
+            item = store.record(index)
+            self.pop_sig.popped.emit(item.x, item.y, "popped")
+        store.reset_position(results)
+
+        missed = ~results
+        store.animate(missed)
+        self.compositor.opaque_circles(in_mat, store.x[missed],
+                                       store.y[missed], store.radius[missed],
+                                       self.color)
 
 
 class Bubble(object):
-    def __init__(self, color=(255,0,0), radius=20, increment=8, start_x=0,
+    def __init__(self, color=(255,0,0), radius=None, increment=None, start_x=0,
                     start_y=0):
         self.max_x = IMG_WIDTH
         self.max_y = IMG_HEIGHT
@@ -346,10 +408,14 @@ class Bubble(object):
             self.x = random.randrange(0, self.max_x, 1)
         self.y = start_y
         if start_y == 0:
-            self.y = -10 - random.randrange(100, self.max_y, 1)
+            self.y = self.start_height()
+        if radius is None:
+            radius = scaled(20)
         self.radius = radius
     
         self.color = color
+        if increment is None:
+            increment = bubble_increment()
         self.increment = increment
         self.points = 10
 
@@ -357,6 +423,10 @@ class Bubble(object):
         self.opacity = 1
         self.opacity_increment = 0.01
 
+        # How much of the bubble has to touch motion to pop it, see collision
+        self.hit_policy = collision.CENTER
+        self.hit_fraction = 0.25
+
         class popObj(QObject):
             popped = pyqtSignal(int, int, 'QString')
         self.pop_sig = popObj()
@@ -366,10 +436,14 @@ class Bubble(object):
         # Add the radius distance to make sure huge bubbles animate all the way
         # off screen
         if self.y > (self.max_y + self.radius):
-            self.y = -10 - random.randrange(100, self.max_y, 1)
+            self.y = self.start_height()
             self.x = random.randrange(0, self.max_x, 1)
             #self.x = 160
 
+    def start_height(self):
+        # Somewhere above the top edge, so bubbles don't all arrive at once
+        return -scaled(10) - random.randrange(scaled(100), self.max_y, 1)
+
     # Gradually fade the bubble out so it is no longer visible
     # if it's transparent, move it off the screen so the popped bubble animation
     # resets
@@ -394,21 +468,18 @@ class Bubble(object):
                    thickness=-1, lineType=cv2.CV_AA)
 
     def local_pop_check(self, motion_blob_mat):
-        if self.y <= 0 or self.y >= IMG_HEIGHT : return 0
-        if self.x <= 0 or self.x >= IMG_WIDTH : return 0
-       
-        # Is there motion precisely where the bubble is?
-        mot_threshold = 1
-        if motion_blob_mat.item(self.y, self.x) > mot_threshold:
-            return 1
-        return 0
+        return collision.pop_check(motion_blob_mat, self.x, self.y,
+                                   self.radius, self.hit_policy,
+                                   self.hit_fraction)
 
 
 class RoughTest(Bubble):
     ''' 
     Constantly in flux place holder for trying different effects.
     '''
-    def __init__(self, in_ref_mat, in_radius=10, duration=10):
+    def __init__(self, in_ref_mat, in_radius=None, duration=10):
+        if in_radius is None:
+            in_radius = scaled(10)
         Bubble.__init__(self, color=(128,255,128), radius=in_radius)
         logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
             level=logging.DEBUG)
@@ -437,65 +508,71 @@ class RoughTest(Bubble):
 
 
 class SkeletonBubble(Bubble):
-    def __init__(self, in_ref_mat, in_radius=10, duration=10):
+    def __init__(self, in_ref_mat, in_radius=None, duration=10):
+        if in_radius is None:
+            in_radius = scaled(10)
         Bubble.__init__(self, color=(128,255,128), radius=in_radius)
         self.enabled = True
         self.preproc_enabled = True
 
         self.pass_count_threshold = 100
+        self.engine = skeleton.SkeletonEngine(method=SKELETON_METHOD,
+                                              budget_ms=SKELETON_BUDGET_MS)
+        self.changes = motion.MaskChangeDetector(MASK_CHANGE_FRACTION,
+                                                 MASK_REFRESH_FRAMES)
+        self.heavy = True
+        self.offload_skel = None
+        self.offload_frame = None
 
 
     def pre_process(self, in_mat, in_motion_mat):
         '''
-        Based on: http://opencvpython.blogspot.com/2012/05/\
-                skeletonization-using-opencv-python.html
         Provide a primitive skeletonization effect of the motion blob previously
-        detected. Take the motion blob, convert it back to full color, then run
-        that through the skeletonization procedure and display that over the
-        recorded background image.
+        detected, see skeleton.py. The skeleton replaces both the displayed
+        frame and the motion blob. While the blob barely changes the previous
+        skeleton is shown again.
         '''
+        if self.engine.max_passes != self.pass_count_threshold:
+            self.engine.max_passes = self.pass_count_threshold
+            self.changes.force()
 
-        new_color = cv2.cvtColor(in_motion_mat, cv2.COLOR_GRAY2BGR)
-        img = cv2.cvtColor(new_color, cv2.COLOR_BGR2GRAY)
-
-        #img = in_motion_mat
-        size = numpy.size(img)
-        skel = numpy.zeros(img.shape,numpy.uint8)
-       
-        ret,img = cv2.threshold(img,127,255,0)
-        element = cv2.getStructuringElement(cv2.MORPH_CROSS,(3,3))
-        done = False
-      
-        pass_count = 0
-        while( not done):
-            eroded = cv2.erode(img,element)
-            temp = cv2.dilate(eroded,element)
-            temp = cv2.subtract(img,temp)
-            skel = cv2.bitwise_or(skel,temp)
-            img = eroded.copy()
-        
-            pass_count += 1
-            if pass_count > self.pass_count_threshold:
-                #print "force exit", pass_count
-                return skel, skel
-
-
-            zeros = size - cv2.countNonZero(img)
-
-            if zeros==size:
-                done = True
-                #print "pass count ", pass_count
-
-        #print "end of the line exit", pass_count
+        # A budgeted skeleton in progress keeps going on its own mask
+        if self.engine.working or self.changes.changed(in_motion_mat):
+            skel = self.engine.skeletonize(in_motion_mat)
+        else:
+            skel = self.engine.latest()
         return skel, skel
 
+    # With --offload the skeleton is computed in a worker process, see
+    # offload.py
+    def offload_wanted(self, in_motion_mat):
+        if self.engine.max_passes != self.pass_count_threshold:
+            self.engine.max_passes = self.pass_count_threshold
+            self.changes.force()
+        return self.changes.changed(in_motion_mat)
+
+    def offload_job(self):
+        return 'skeleton', (self.engine.method, self.pass_count_threshold)
+
+    def offload_collect(self, output, result):
+        if self.offload_skel is None:
+            self.offload_skel = output.copy()
+            self.offload_frame = numpy.empty_like(output)
+        else:
+            numpy.copyto(self.offload_skel, output)
 
+    def offload_apply(self, in_mat, in_motion_mat):
+        # The frame gets drawn on, so like SkeletonEngine.latest() hand out
+        # the newest skeleton in a buffer that is reused every frame
+        if self.offload_skel is None: return
+        numpy.copyto(self.offload_frame, self.offload_skel)
+        return self.offload_frame, self.offload_frame
 
 
-    def game_process(self, in_mat, in_motion_mat):
+    def game_process(self, in_mat, in_collision):
         if self.preproc_enabled: return
 
-        result = self.local_pop_check(in_motion_mat)
+        result = self.local_pop_check(in_collision)
         if result:
             self.pop_sig.popped.emit(self.x, self.y, "popped")
             self.reset_position()
@@ -510,29 +587,57 @@ class SkeletonBubble(Bubble):
 
 
 class FireBubble(Bubble):
-    def __init__(self, in_ref_mat, in_radius=10, duration=10):
+    def __init__(self, in_ref_mat, in_radius=None, duration=10):
+        if in_radius is None:
+            in_radius = scaled(10)
         Bubble.__init__(self, color=(128,255,128), radius=in_radius)
         self.enabled = True
         self.preproc_enabled = True
 
         self.fire_ref_color = in_ref_mat
+        self.changes = motion.MaskChangeDetector(MASK_CHANGE_FRACTION,
+                                                 MASK_REFRESH_FRAMES)
+        self.contours = []
+        self.hier = None
+        self.heavy = True
 
 
     # Draw the contours around the motion blob, animate color fire coming out
     def pre_process(self, in_mat, in_motion_mat):
 
-        conts, hier = cv2.findContours( in_motion_mat, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        contours = [cv2.approxPolyDP(cnt, 3, True) for cnt in conts]
+        # Only trace the blob again when it has moved
+        if self.changes.changed(in_motion_mat):
+            conts, hier = cv2.findContours( in_motion_mat, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+            self.contours = [cv2.approxPolyDP(cnt, 3, True) for cnt in conts]
+            self.hier = hier
+
+        self.draw_contours(in_mat)
+
+    def draw_contours(self, in_mat):
+        if not self.contours: return
 
         levels = 3
-        cv2.drawContours(in_mat, contours, (-1,3)[levels <= 0], (128,255,255),
-                3, cv2.CV_AA, hier, abs(levels) )
+        cv2.drawContours(in_mat, self.contours, (-1,3)[levels <= 0], (128,255,255),
+                3, cv2.CV_AA, self.hier, abs(levels) )
+
+    # With --offload the contours are traced in a worker process
+    def offload_wanted(self, in_motion_mat):
+        return self.changes.changed(in_motion_mat)
+
+    def offload_job(self):
+        return 'contours', 3
+
+    def offload_collect(self, output, result):
+        self.contours, self.hier = result
 
+    def offload_apply(self, in_mat, in_motion_mat):
+        self.draw_contours(in_mat)
 
-    def game_process(self, in_mat, in_motion_mat):
+
+    def game_process(self, in_mat, in_collision):
         if self.preproc_enabled: return
 
-        result = self.local_pop_check(in_motion_mat)
+        result = self.local_pop_check(in_collision)
         if result:
             self.pop_sig.popped.emit(self.x, self.y, "popped")
             self.reset_position()
@@ -554,10 +659,13 @@ class SmoosherBubble(Bubble):
     over the reference image for a 'you shrunk me!' mode. Timers execute an
     animated restoration to normal size.
     '''
-    def __init__(self, in_ref_mat, in_radius=20, duration=10):
+    def __init__(self, in_ref_mat, in_timers, in_radius=None, duration=10):
+        if in_radius is None:
+            in_radius = scaled(20)
         Bubble.__init__(self, color=(0,255,0), radius=in_radius )
         self.enabled = True
         self.preproc_enabled = False
+        self.timers = in_timers
 
         self.smoosh_ref_color = in_ref_mat
         self.min_down_scale = 0.25
@@ -565,54 +673,62 @@ class SmoosherBubble(Bubble):
         self.up_scale_increment = 0.10
         self.scale_factor = 1
         self.scale_mode = 1
+        self.work_shape = None
+
 
+    def allocate(self, in_mat):
+        # Work buffers live as long as the bubble, the shrunken images are
+        # views into the top left corner of full size ones
+        shape = in_mat.shape
+        if self.work_shape == shape: return
+        self.work_shape = shape
+        self.back_col = numpy.empty(shape, numpy.uint8)
+        self.mask_res = numpy.empty(shape, numpy.uint8)
+        self.down_buf = numpy.empty(shape, numpy.uint8)
+        self.gray_buf = numpy.empty(shape[:2], numpy.uint8)
 
     def pre_process(self, in_mat, in_motion_mat):
-        # Create an all black background image with the shrunken
-        # motion area on top of it
-        back_col = cv2.cvtColor(in_motion_mat, cv2.COLOR_GRAY2BGR)
-        mask_res = cv2.bitwise_and(in_mat, back_col)
+        self.allocate(in_mat)
+
+        # Keep only the camera pixels inside the motion area
+        cv2.cvtColor(in_motion_mat, cv2.COLOR_GRAY2BGR, self.back_col)
+        cv2.bitwise_and(in_mat, self.back_col, self.mask_res)
 
         ds = self.scale_factor
-        down_res = cv2.resize(mask_res, (0,0), fx=ds, fy=ds) 
+        down_w = max(int(round(IMG_WIDTH * ds)), 1)
+        down_h = max(int(round(IMG_HEIGHT * ds)), 1)
+        down_res = self.down_buf[:down_h, :down_w]
+        cv2.resize(self.mask_res, (down_w, down_h), down_res)
 
         # Define the place for the shrunken result on the new image. Put it in
         # the center lower middle so it looks like you're in the scene
-        y_top = IMG_HEIGHT - down_res.shape[0]
-        y_bot = y_top + down_res.shape[0] 
-        x_lef = (IMG_WIDTH - down_res.shape[1])/2
-        x_rig = x_lef + down_res.shape[1]
-
-        # Broadcast the new mask into an all black (color) image
-        size = IMG_HEIGHT, IMG_WIDTH, 3
-        black_fr = numpy.zeros(size, dtype=numpy.uint8)
+        y_top = IMG_HEIGHT - down_h
+        y_bot = y_top + down_h
+        x_lef = (IMG_WIDTH - down_w)/2
+        x_rig = x_lef + down_w
 
         # Rough and ready y axis shift of shrink so it's not behind the text
         y_offset = 0
         y_diff = y_bot - y_top
-        if y_diff < 200:
-            y_offset = 20
+        if y_diff < scaled(200):
+            y_offset = scaled(20)
         y_top -= y_offset
         y_bot -= y_offset
-        black_fr[y_top:y_bot, x_lef:x_rig] = down_res
 
-        # Convert to gray, use to create an inverse mask of the
-        # reference.
-        newm_res = cv2.cvtColor(black_fr, cv2.COLOR_BGR2GRAY)
-
-        ret, nthr_res = cv2.threshold(newm_res, 1, 255,
-                cv2.THRESH_BINARY)
-        nthr_res = cv2.bitwise_not(nthr_res)
-        retc_res = cv2.cvtColor(nthr_res, cv2.COLOR_GRAY2BGR)
-        back_res = cv2.bitwise_and(self.smoosh_ref_color, retc_res)
-
-        # Now bitwise and them together to preserve the color
-        # information
-        cv2.bitwise_or(back_res, black_fr, in_mat)
-
-        # Now take the shrunken down motion mask and set it as the input image
-        # for better collision detection, flip the inverse back 
-        cv2.bitwise_not(nthr_res, in_motion_mat)
+        # The shrunken motion mask becomes the motion input for better
+        # collision detection, it is empty outside the shrunken actor
+        actor = in_motion_mat[y_top:y_bot, x_lef:x_rig]
+        down_gray = self.gray_buf[:down_h, :down_w]
+        cv2.cvtColor(down_res, cv2.COLOR_BGR2GRAY, down_gray)
+        in_motion_mat.fill(0)
+        cv2.threshold(down_gray, 1, 255, cv2.THRESH_BINARY, actor)
+
+        # The reference everywhere, then the shrunken actor on top of it. Only
+        # the actor's rectangle needs any compositing.
+        numpy.copyto(in_mat, self.smoosh_ref_color)
+        roi = in_mat[y_top:y_bot, x_lef:x_rig]
+        cv2.bitwise_or(roi, down_res, roi)
+        cv2.bitwise_and(down_res, down_res, roi, mask=actor)
 
         self.animate_pre_process()
         return in_mat, in_motion_mat
@@ -625,7 +741,7 @@ class SmoosherBubble(Bubble):
             self.scale_factor -= self.down_scale_increment
             if self.scale_factor <= self.min_down_scale:
                 self.scale_factor = self.min_down_scale
-                QTimer.singleShot(3000, self.toggle_mode)
+                self.timers.single_shot(3000, self.toggle_mode)
         else:
             self.scale_factor += self.up_scale_increment
             if self.scale_factor >= 1:
@@ -634,11 +750,11 @@ class SmoosherBubble(Bubble):
     def toggle_mode(self):
         self.scale_mode = 0 
 
-    def game_process(self, in_mat, in_motion_mat):
+    def game_process(self, in_mat, in_collision):
         if self.preproc_enabled: return
         self.scale_mode = 1 # Make sure the shrink animation is restored
 
-        result = self.local_pop_check(in_motion_mat)
+        result = self.local_pop_check(in_collision)
         if result:
             self.pop_sig.popped.emit(self.x, self.y, "popped")
             self.down_scale = 1
@@ -657,14 +773,15 @@ class UpBubble(Bubble):
     Animate a circle that goes up from the popped bubble location for a simple
     pop feedback effect.
     '''
-    def __init__(self, in_x, in_y, in_radius):
+    def __init__(self, in_x, in_y, in_radius, in_compositor):
         Bubble.__init__(self, color=(255,0,0))
         self.enabled = True
+        self.compositor = in_compositor
         self.x = in_x
         self.y = in_y
         self.radius = in_radius
         self.radius_increment = 1
-        self.animate_distance = self.y - 75
+        self.animate_distance = self.y - scaled(75)
 
     def animate(self):
         self.y -= self.increment
@@ -675,10 +792,11 @@ class UpBubble(Bubble):
         if self.y <  self.animate_distance:
             self.enabled = False
 
-    def game_process(self, in_mat, in_motion_mat):
+    def game_process(self, in_mat, in_collision):
         self.animate()
-        cv2.circle(in_mat, (self.x, self.y), int(self.radius), self.color,
-                    thickness=1, lineType=cv2.CV_AA)
+        self.compositor.opaque_circle(in_mat, (self.x, self.y),
+                                      int(self.radius), self.color,
+                                      thickness=1)
 
 
 
@@ -687,89 +805,131 @@ class BadBubble(Bubble):
     The red bubble that pops the green mess all over the player, as well as
     decreases the score.
     '''
-    def __init__(self, in_radius=20):
-        Bubble.__init__(self, color=(0,0,255), radius=in_radius)
+    def __init__(self, in_compositor, in_radius=20, in_increment=None):
+        Bubble.__init__(self, color=(0,0,255), radius=in_radius,
+                        increment=in_increment)
         self.enabled = True
+        self.compositor = in_compositor
+
+        # Expand the collision boundary detection to cover more than just the
+        # center of the bubble. This is important as the circle can become
+        # huge.
+        self.hit_policy = collision.SQUARE
 
     def harder(self, in_chg):
         # Make the bubble bigger
         self.radius += in_chg
 
-    def game_process(self, in_mat, in_motion_mat):
-        result = self.local_pop_check(in_motion_mat)
+    def game_process(self, in_mat, in_collision):
+        result = self.local_pop_check(in_collision)
         if result:
             self.pop_sig.popped.emit(self.x, self.y, "popped")
             self.reset_position()
 
         else:
             self.animate()
-            cv2.circle(in_mat, (self.x, self.y), self.radius, self.color,
-                        thickness=-1, lineType=cv2.CV_AA)
-
-
-    def local_pop_check(self, motion_blob_mat):
-        '''
-        Expand the collision boundary detection to cover more than just the
-        center of the bubble (default). Proscribe an internal square boundary
-        box that covers a large portion of the 'collision area' within the
-        circle. This is important as the circle can become huge. 
-        '''
-
-        if self.y <= 0 or self.y >= IMG_HEIGHT : return 0
-        if self.x <= 0 or self.x >= IMG_WIDTH : return 0
-       
-        # Check square edge that is sure to be in the radius
-        mot_threshold = 1
-        radius_margin = self.radius / 4
-        start_x = self.x - (self.radius - radius_margin)
-        end_x   = self.x + (self.radius - radius_margin)
-        start_y = self.y - (self.radius - radius_margin)
-        end_y   = self.y + (self.radius - radius_margin)
-        if start_y < 0: start_y = 0
-        if start_x < 0: start_x = 0
-        if end_y > IMG_HEIGHT: end_y = IMG_HEIGHT
-        if end_x > IMG_WIDTH : end_x = IMG_WIDTH
-
-        y_jump = 1
-        x_jump = 1
-
-        curr_y = start_y
-        try:
-            while curr_y < end_y:
-                curr_x = start_x
-                while curr_x < end_x:
-                    if motion_blob_mat.item(curr_y, curr_x) > mot_threshold:
-                        return 1
-                    curr_x += x_jump
-
-                curr_y += y_jump
-        except IndexError:
-            # Assume it's at an edge, so ignore it
-            pass
-
-        return 0
+            self.compositor.opaque_circle(in_mat, (self.x, self.y),
+                                          self.radius, self.color)
 
 
 class MainBubbler(QObject):
-    def __init__(self):
+    '''
+    Owns the camera, the effect stages and the frame loop. With headless set
+    there are no HighGUI windows and no timers: the caller (see benchmark.py)
+    drives the loop by calling process_frame() and adds effects itself.
+    '''
+    def __init__(self, source=None, headless=False):
         super(MainBubbler, self).__init__()
 
         logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
             level=logging.DEBUG)
         self.log = logging.getLogger()
 
-        self.setup_video_and_windows()
-        self.setup_queues()
-
-        self.rm = ReferenceMAT()
-        self.di = DebugInfo()
+        self.headless = headless
+        self.closed = False
+
+        # Game timers fire between frames, by the frame's time stamp
+        self.timers = frameclock.FrameTimers()
+        self.clock_start = clock()
+
+        # Worker processes for the heavy effects, started before any thread
+        self.offload = None
+        if OFFLOAD_PROCESSES > 0:
+            self.offload = offload.OffloadPool(IMG_WIDTH, IMG_HEIGHT,
+                                               OFFLOAD_PROCESSES)
+
+        self.setup_video_and_windows(source)
+
+        # Share the composed frames with other local processes, see
+        # framebus.py for the viewer
+        self.frame_bus = None
+        if FRAME_BUS is not None:
+            self.frame_bus = framebus.FrameBus(FRAME_BUS, IMG_WIDTH,
+                                               IMG_HEIGHT)
+
+        # Encode the session on a background thread
+        self.recorder = None
+        if RECORD is not None:
+            self.recorder = recorder.Recorder(RECORD, IMG_WIDTH, IMG_HEIGHT,
+                                              fps=self.recording_fps(),
+                                              policy=RECORD_POLICY,
+                                              with_mask=RECORD_MASK)
+
+        self.scheduler = scheduler.EffectScheduler()
+        self.compositor = compositor.OverlayCompositor(IMG_WIDTH, IMG_HEIGHT)
+        self.sprites = sprites.SpriteCache()
+        self.setup_renderer()
+
+        # Time every stage and effect, 'p' shows the breakdown
+        self.profiler = profiler.FrameProfiler(log_path=PROFILE_LOG)
+        self.scheduler.profiler = self.profiler
+        self.display.profiler = self.profiler
+
+        # Pluggable motion detection, see motion.py for the back-ends
+        self.motion_engine = motion.create(MOTION_ENGINE, scale=MOTION_SCALE,
+                                           kernel_size=BLUR_KERNEL)
+        self.motion_small = None
+        self.motion_bounds = None
+        self._motion_blob = None
+        self.rm = ReferenceMAT(self.motion_engine)
+        self.di = DebugInfo(self.sprites)
 
         # Force initial processing 
         self.rm.pre_process(self.current_frame, self.current_frame)
-        self.post_queue.put(self.di)
+
+        # The frame rate goes on the Processed window, which kiosk mode
+        # doesn't show ('f' still turns it on)
+        if KIOSK:
+            self.di.enabled = False
+        else:
+            self.scheduler.add(scheduler.POST, self.di)
+
+        # From here on the worker owns the camera and the motion engine, new
+        # references go through the pipeline
+        self.pipeline = None
+        if PIPELINE_DEPTH > 0:
+            self.pipeline = pipeline.MotionPipeline(self.cam,
+                                                    self.prepare_frame,
+                                                    self.motion_engine,
+                                                    depth=PIPELINE_DEPTH)
+            self.rm.motion_engine = self.pipeline
+
+        # Shed effect work when frames take too long, see governor.py
+        self.mess_bubbles = MAX_MESS_BUBBLES
+        self.skeleton_budget_ms = SKELETON_BUDGET_MS
+        self.governor = None
+        if TARGET_FPS is not None:
+            self.governor = governor.QualityGovernor(
+                1000.0 / TARGET_FPS, self.quality_knobs(), self.sprites,
+                (IMG_WIDTH - scaled(300), scaled(40)), 1.5 * PIXEL_SCALE,
+                scaled(6))
+            self.scheduler.add(scheduler.POST, self.governor)
+
+        if self.headless:
+            return
 
         # Wait for the camera to stabilize, then set the reference
-        self.ref_timer = QTimer(self)
+        self.ref_timer = frameclock.FrameTimer(self.timers)
         self.ref_timer.timeout.connect(self.new_reference)
         self.ref_timer.setSingleShot(True)
         if DEBUG or VIDEO_ONLY:
@@ -780,10 +940,10 @@ class MainBubbler(QObject):
         # Create the game object which auto-countdown starts after 3 seconds
         if DEBUG:
             if not VIDEO_ONLY:
-                QTimer.singleShot(100, self.create_game)
+                self.timers.single_shot(100, self.create_game)
         else:
             if not VIDEO_ONLY:
-                QTimer.singleShot(2000, self.create_game)
+                self.timers.single_shot(2000, self.create_game)
 
         # Start the main event timer
         self.queue_timer = QTimer(self)
@@ -791,41 +951,161 @@ class MainBubbler(QObject):
         self.queue_timer.setSingleShot(True)
         self.queue_timer.start(0)
 
-    def setup_video_and_windows(self):
-        cap_str = "1:size=" + str(IMG_WIDTH) + "x" + str(IMG_HEIGHT)
+    def setup_video_and_windows(self, source=None):
+        cap_str = str(CAMERA) + ":size=%dx%d" % CAPTURE_SIZE
+        if CAMERA_FPS is not None:
+            cap_str += ":fps=" + str(CAMERA_FPS)
+        if source is not None:
+            cap_str = source
         self.cam = video.create_capture( cap_str )
 
+        # A replayed session hands out its frames and keys in order, and
+        # plays with the random numbers it was recorded with
+        self.replay_source = None
+        seed = None
+        if isinstance(self.cam, replay.ReplayCapture):
+            self.replay_source = self.cam
+            seed = self.cam.seed
+
+        # Grab frames on a background thread so the frame loop never waits on
+        # the camera driver while there is processing to do
+        elif THREADED_CAPTURE:
+            self.cam = capture.CaptureThread(self.cam)
+
+        # Save every frame the game processes, and the keys, for replay
+        self.session = None
+        if SESSION is not None:
+            seed = random.randrange(2 ** 31)
+            self.session = replay.SessionWriter(SESSION, seed, SESSION_FORMAT)
+            self.cam = replay.RecordingCapture(self.cam, self.session)
+
+        if seed is not None:
+            random.seed(seed)
+            numpy.random.seed(seed)
+
         # TODO: can you get speed by flipping in logitech? What if you flip the
         # H.264 stream?
         ret, img = self.cam.read()
-        self.current_frame = cv2.flip(img, 1)
-
-        cv2.namedWindow("Processed", cv2.CV_WINDOW_AUTOSIZE )
-        cv2.moveWindow("Processed",0,0)
-
-        cv2.namedWindow("Live", cv2.WINDOW_OPENGL)
-        cv2.moveWindow("Live",800,0)
+        self.current_frame = self.prepare_frame(img)
+
+        # Kiosk mode shows the game only, and the mask window can refresh
+        # less often than the game, see display.py
+        self.display = display.Display()
+        if self.headless:
+            return
+
+        self.display.add(display.Window(display.PROCESSED,
+                                        cv2.CV_WINDOW_AUTOSIZE, (0, 0),
+                                        max_fps=PROCESSED_FPS,
+                                        enabled=not KIOSK))
+        live_x = 0 if KIOSK else IMG_WIDTH
+        self.display.add(display.Window(display.LIVE, cv2.WINDOW_OPENGL,
+                                        (live_x, 0), max_fps=LIVE_FPS))
+
+    def setup_renderer(self):
+        # Draw the bubbles on the GPU, see glrender.py
+        self.gl_renderer = None
+        if RENDERER != 'opengl' or self.headless:
+            return
+        if not glrender.available():
+            self.log.warn("OpenGL rendering needs PyOpenGL and OpenCV built "
+                          "with OpenGL, using the software renderer")
+        elif self.frame_bus is not None or self.recorder is not None:
+            self.log.warn("The frame bus and the recorder only get frames "
+                          "from the software renderer, using it")
+        else:
+            self.compositor = glrender.GLCompositor(IMG_WIDTH, IMG_HEIGHT)
+            # The HUD text goes over the circles, so the renderer draws it
+            self.sprites = glrender.GLSpriteCache(self.compositor)
+            self.gl_renderer = glrender.GLRenderer(display.LIVE, IMG_WIDTH,
+                                                   IMG_HEIGHT,
+                                                   self.compositor)
+            self.display.window(display.LIVE).renderer = self.gl_renderer
+
+    def quality_knobs(self):
+        # A knob whose degraded setting is what the profile already runs with
+        # would only cost a level and a hold, so it is left out
+        knobs = []
+
+        # The motion engine belongs to the worker thread in pipelined mode
+        if self.pipeline is None and self.motion_engine.scale < 4:
+            def motion_scale(scale):
+                def apply():
+                    self.motion_engine.scale = scale
+                    self.motion_engine.reset(self.rm.reference_color)
+                return apply
+            knobs.append(governor.Knob('motion',
+                    motion_scale(self.motion_engine.scale * 2),
+                    motion_scale(self.motion_engine.scale)))
+
+        # The GL renderer draws its own edges, the line type does nothing
+        if not isinstance(self.compositor, glrender.GLCompositor):
+            def line_type(value):
+                def apply():
+                    self.compositor.line_type = value
+                return apply
+            # 8 is the plain 8-connected line type
+            knobs.append(governor.Knob('aa', line_type(8),
+                                       line_type(cv2.CV_AA)))
+
+        def mess_bubbles(count):
+            def apply():
+                self.mess_bubbles = count
+            return apply
+        fewer = max(MAX_MESS_BUBBLES / 2, 1)
+        if fewer != MAX_MESS_BUBBLES:
+            knobs.append(governor.Knob('mess', mess_bubbles(fewer),
+                                       mess_bubbles(MAX_MESS_BUBBLES)))
+
+        def skeleton_budget(budget_ms):
+            def apply():
+                self.skeleton_budget_ms = budget_ms
+                if hasattr(self, 'skb'):
+                    self.skb.engine.budget_ms = budget_ms
+            return apply
+        budget = 4
+        if SKELETON_BUDGET_MS is not None:
+            budget = min(budget, SKELETON_BUDGET_MS)
+        if budget != SKELETON_BUDGET_MS:
+            knobs.append(governor.Knob('skeleton', skeleton_budget(budget),
+                                       skeleton_budget(SKELETON_BUDGET_MS)))
+
+        window = self.display.window(display.PROCESSED)
+        if window is not None and window.enabled:
+            def refresh(max_fps):
+                def apply():
+                    window.max_fps = max_fps
+                return apply
+            slow = 5
+            if window.max_fps is not None:
+                slow = min(slow, window.max_fps)
+            if slow != window.max_fps:
+                knobs.append(governor.Knob('window', refresh(slow),
+                                           refresh(window.max_fps)))
+        return knobs
 
     def create_game(self):
-        self.gc = GameControl()
+        self.gc = GameControl(self.sprites, self.timers)
         self.gc.game_sig.start_game.connect(self.on_start_game)
         self.gc.game_sig.stop_game.connect(self.on_stop_game)
-        self.post_queue.put(self.gc)
+        self.scheduler.add(scheduler.POST, self.gc)
 
+        self.add_smoosher_timer = frameclock.FrameTimer(self.timers)
+        self.add_smoosher_timer.setSingleShot(True)
+        self.add_smoosher_timer.timeout.connect(self.add_smoosher)
 
     def on_start_game(self):
         self.log.info("Start game")
-        tg = GroupBubbles()
+        tg = GroupBubbles(self.compositor, self.gc.max_bubbles,
+                          self.gc.good_radius, self.gc.good_increment)
         tg.pop_sig.popped.connect(self.on_good_pop)
-        self.game_queue.put( tg )
+        self.scheduler.add(scheduler.GAME, tg)
 
-        self.bb = BadBubble( self.gc.bad_radius )
+        self.bb = BadBubble(self.compositor, self.gc.bad_radius,
+                            self.gc.bad_increment)
         self.bb.pop_sig.popped.connect(self.on_bad_pop)
-        self.game_queue.put( self.bb )
+        self.scheduler.add(scheduler.GAME, self.bb)
     
-        self.add_smoosher_timer = QTimer()
-        self.add_smoosher_timer.setSingleShot(True)
-        self.add_smoosher_timer.timeout.connect(self.add_smoosher)
         if DEBUG:
             self.add_smoosher_timer.start(1000)
         else:
@@ -833,34 +1113,36 @@ class MainBubbler(QObject):
 
     def on_stop_game(self):
         self.log.info("Stop game")
-        # temporarily stop the queue
-        self.queue_timer.stop()
-
-        # dequeue all the objects
-        while True:
-            try:
-                item = self.game_queue.get_nowait()
-            except Queue.Empty:
-                break
-            except:
-                self.log.critical("Clear GAMEPROCQ: " + str(sys.exc_info()))
-                break
-
-        # Restart the queue
-        self.queue_timer.start(1)
-
-    def setup_queues(self):
-        self.pre_queue = Queue.Queue()
-        self.post_queue = Queue.Queue()
-        self.game_queue = Queue.Queue()
+        self.scheduler.clear(scheduler.GAME)
 
     def closeEvent(self):
+        if self.closed: return
+        self.closed = True
         cv2.destroyAllWindows()
-        self.queue_timer.stop()
+        if not self.headless:
+            self.queue_timer.stop()
+            self.log.info("Display: " + self.display.summary())
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        if self.offload is not None:
+            self.offload.close()
+        if self.frame_bus is not None:
+            self.frame_bus.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        if THREADED_CAPTURE and self.replay_source is None:
+            self.cam.stop()
+        if self.session is not None:
+            self.session.close()
+        self.profiler.close()
+        if not self.headless:
+            QApplication.quit()
 
     def on_good_pop(self, in_x, in_y):
         #self.log.info("on good pop " + str(in_x) + " " + str(in_y))
-        self.game_queue.put( UpBubble(in_x, in_y, self.gc.good_radius) )
+        self.scheduler.add(scheduler.GAME,
+                           UpBubble(in_x, in_y, self.gc.good_radius,
+                                    self.compositor))
         self.gc.score_good( 10 )
 
     def on_bad_pop(self, in_x, in_y):
@@ -871,65 +1153,83 @@ class MainBubbler(QObject):
         self.bb.enabled = False
         self.bb.harder( self.gc.bad_radius_jump)
 
-        mg = MessBubbles(in_x, in_y)
+        mg = MessBubbles(in_x, in_y, self.compositor, self.mess_bubbles)
         mg.done_sig.done_animation.connect(self.mess_done)
-        self.game_queue.put( mg )
+        self.scheduler.add(scheduler.GAME, mg)
 
     def mess_done(self, in_x, in_y):
         self.log.info("reenable bad bubble")
         self.bb.enabled = True
-        self.game_queue.put( self.bb )
+        self.scheduler.add(scheduler.GAME, self.bb)
 
     def new_reference(self):
-        self.pre_queue.put( self.rm )
+        self.scheduler.add(scheduler.PRE, self.rm, priority=-1)
 
     def add_chopper(self):
         self.log.info("add chopper")
 
     def add_smoosher(self):
         self.log.info("add smoosher")
-        self.sb = SmoosherBubble( self.rm.reference_color,
+        self.sb = SmoosherBubble( self.rm.reference_color, self.timers,
                 duration=self.gc.show_smoosh_duration)
         self.sb.pop_sig.popped.connect(self.on_smoosher_pop)
-        self.game_queue.put( self.sb )
+        self.scheduler.add(scheduler.GAME, self.sb)
 
     def add_fire(self):
         self.log.info("Add fire ")
         self.fb = FireBubble(self.rm.reference_color)
-        self.pre_queue.put( self.fb )
+        self.scheduler.add(scheduler.PRE, self.fb)
 
     def add_skeleton(self):
         self.log.info("skeleton")
         self.skb = SkeletonBubble(self.rm.reference_color)
-        self.pre_queue.put( self.skb )
+        self.skb.engine.budget_ms = self.skeleton_budget_ms
+        self.scheduler.add(scheduler.PRE, self.skb)
 
     def on_smoosher_pop(self):
         self.log.info("on smoosher pop")
         self.sb.preproc_enabled = True
-        self.pre_queue.put( self.sb )
-        QTimer.singleShot(6000, self.reset_smoosher_start)
+        self.scheduler.add(scheduler.PRE, self.sb)
+        self.timers.single_shot(6000, self.reset_smoosher_start)
 
     def reset_smoosher_start(self):
         self.log.info("Reset smoosher")
         self.sb.preproc_enabled = False
 
     def find_motion(self, in_frame):
-        self.primary_kernel_size = 20
-        self.primary_threshold_level = 20
-
-        reference_gray = self.rm.reference_gray
-
-        gray_frame = cv2.cvtColor(in_frame, cv2.COLOR_BGR2GRAY)
-        diff_frame = cv2.absdiff(reference_gray, gray_frame)
-
-        kernel_size = self.primary_kernel_size
-        blur_frame = cv2.blur(diff_frame, (kernel_size, kernel_size))
-
-        threshold_level = self.primary_threshold_level
-        ret, thre_frame = cv2.threshold( blur_frame, threshold_level, 255,
-                        cv2.THRESH_BINARY)
-
-        return thre_frame
+        return self.motion_engine.apply(in_frame)
+
+    # The motion engine may run at a reduced resolution. The full size mask
+    # is only produced the first time something in the frame asks for it,
+    # such as a pre effect (smoosher, skeleton), the post overlays or the
+    # "Processed" window.
+    @property
+    def motion_blob(self):
+        if self._motion_blob is None:
+            self._motion_blob = motion.expand(self.motion_small, IMG_WIDTH,
+                                              IMG_HEIGHT)
+        return self._motion_blob
+
+    @motion_blob.setter
+    def motion_blob(self, mask):
+        self._motion_blob = mask
+
+    def build_collision_index(self):
+        # Once a pre effect has touched the full size mask (the smoosher
+        # replaces it) that is the one to collide with
+        if self._motion_blob is not None:
+            return collision.CollisionIndex(self._motion_blob)
+        return collision.CollisionIndex(self.motion_small,
+                                        self.motion_engine.scale,
+                                        self.motion_bounds)
+
+    def prepare_frame(self, img):
+        # Recorded video (and cameras that ignore the size request) may not
+        # match the processing size
+        frame = cv2.flip(img, 1)
+        if frame.shape[1] != IMG_WIDTH or frame.shape[0] != IMG_HEIGHT:
+            frame = cv2.resize(frame, (IMG_WIDTH, IMG_HEIGHT))
+        return frame
 
     def process_queues(self):
         # Every N msec, process the three queues:
@@ -941,102 +1241,184 @@ class MainBubbler(QObject):
         # process queue as well as rendering changes to post process and
         # different rules to game progress queue
 
-        # First, get the current frame from the camera
-        ret, self.img = self.cam.read()
-        self.current_frame = cv2.flip(self.img, 1)
-
-        # This should probably be moved to a pre processing object
-        self.motion_blob = self.find_motion(self.current_frame)
-
-        self.pre_process()
-        self.game_process()
-        self.post_process()
+        if self.process_frame():
+            if self.frame_bus is not None:
+                with self.profiler.section('frame_bus'):
+                    self.frame_bus.publish(self.current_frame)
+            if self.recorder is not None:
+                with self.profiler.section('record'):
+                    self.record_frame()
+            with self.profiler.section('display'):
+                self.display_image()
+        else:
+            self.log.warn("No frame from camera")
 
-        self.display_image()
-        self.queue_timer.start(1)
+        self.profiler.end_frame()
+        self.govern()
 
-    def pre_process(self):
-        post_list = []
-        while True:
-            try:
-                item = self.pre_queue.get_nowait()
-                #self.log.info("Preproc " + str(item))
-                cf, mb = item.pre_process(self.current_frame, self.motion_blob)
-                self.current_frame, self.motion_blob = cf, mb
-                post_list.append(item)
+        # After 'q' the camera, frame bus and recorder are gone
+        if not self.closed:
+            self.queue_timer.start(1)
 
-            except Queue.Empty:
-                break
+    def govern(self):
+        ''' Feed the time of the frame that just ended to the governor. '''
+        if self.governor is None: return
+        # The wait for the camera is not work the governor can shed
+        prof = self.profiler
+        self.governor.update(prof.last_frame_time -
+                             prof.current.get('capture', 0.0))
 
-            except:
-                self.log.critical("PREPROCQ: " + str(sys.exc_info()))
-                break
+    def process_frame(self):
+        '''
+        Run one frame through capture, motion detection and the three effect
+        stages. Returns False when the camera had no frame.
+        '''
+        prof = self.profiler
+        prof.begin_frame()
+
+        if self.pipeline is not None:
+            # The worker already read the frame and found its motion
+            with prof.section('capture'):
+                slot = self.pipeline.read()
+            if slot is None:
+                return False
+            prof.add('worker:find_motion', slot.seconds)
+            stamp = slot.stamp
+            self.current_frame = slot.frame
+            self.motion_small = slot.mask
+            self.motion_bounds = slot.bounds
+            self._motion_blob = None
 
-        for preproc_item in post_list:
-            if preproc_item.preproc_enabled:
-                #self.log.info("Re-add " + str(preproc_item))
-                self.pre_queue.put(preproc_item)
+        else:
+            # First, get the current frame from the camera. With threaded
+            # capture this is the newest frame in the ring, and the flip
+            # copies it out before the capture thread can reuse the slot
+            with prof.section('capture'):
+                ret, self.img = self.cam.read()
+            if not ret:
+                return False
+            stamp = getattr(self.cam, 'stamp', None)
+            self.current_frame = self.prepare_frame(self.img)
+
+            # This should probably be moved to a pre processing object
+            with prof.section('find_motion'):
+                self.motion_small = self.find_motion(self.current_frame)
+                self.motion_bounds = self.motion_engine.motion_bounds()
+                self._motion_blob = None
+
+        # Fire the game timers due by this frame. Recorded and replayed
+        # frames carry the time they were recorded at, see frameclock.py
+        with prof.section('timers'):
+            if stamp is None:
+                stamp = clock() - self.clock_start
+            self.timers.advance(stamp)
+
+        with prof.section('pre'):
+            if self.offload is not None:
+                self.offload.begin_frame()
+            self.pre_process()
+
+        # Pre processing can replace the motion mask (the smoosher does), so
+        # index the final mask once and let every bubble test against it
+        with prof.section('game'):
+            self.collision_index = self.build_collision_index()
+            self.game_process()
+
+        with prof.section('composite'):
+            self.compositor.composite(self.current_frame)
+
+        with prof.section('post'):
+            self.post_process()
+
+        return True
 
+    def pre_process(self):
+        self.scheduler.run(scheduler.PRE, self.pre_process_effect)
 
+    def pre_process_effect(self, item):
+        if self.offload is not None and getattr(item, 'heavy', False):
+            result = self.offload.pre_process(item, self.current_frame,
+                                              self.motion_blob)
+        else:
+            result = item.pre_process(self.current_frame, self.motion_blob)
+        # Effects that only draw on the frame don't return anything
+        if result is not None:
+            self.current_frame, self.motion_blob = result
 
     def game_process(self):
-        post_list = []
-        while True:
-            try:
-                item = self.game_queue.get_nowait()
-                #self.log.info("GAMEQ" + str(item))
-                item.game_process(self.current_frame, self.motion_blob)
-                post_list.append(item)
-
-            except Queue.Empty:
-                #self.log.info("game empty" + str(sys.exc_info()))
-                break
-
-            except:
-                self.log.critical("GAMEQ: " + str(sys.exc_info()))
-                self.log.critical(str(sys.exc_traceback.tb_lineno ))
-                
-                break
-
-        # Check if items are still enabled, put them back on the queue for the
-        # next pass
-        # TODO: do these items get destroyed automatically?
-        for game_item in post_list:
-            if game_item.enabled:
-                #self.log.info("Re-add " + str(game_item))
-                self.game_queue.put(game_item)
-    
+        self.scheduler.run(scheduler.GAME, self.game_process_effect)
 
+    def game_process_effect(self, item):
+        item.game_process(self.current_frame, self.collision_index)
 
     def post_process(self):
-        post_list = []
-        while True:
-            try:
-                item = self.post_queue.get_nowait()
-                #self.log.info("POSTPROCQ" + str(item))
-                item.post_process(self.current_frame, self.motion_blob)
-                post_list.append(item)
-
-            except Queue.Empty:
-                #self.log.info("post empty" + str(sys.exc_info()))
-                break
-
-            except:
-                self.log.critical("POSTPROCQ: " + str(sys.exc_info()))
-                break
-
-        # Put this back on the queue for processing next pass
-        for effect in post_list:
-            if effect.enabled:
-                self.post_queue.put(effect)
+        self.scheduler.run(scheduler.POST, self.post_process_effect)
+
+    def post_process_effect(self, item):
+        # Only the overlays of the Processed window need the full size mask,
+        # and only on frames the window shows. The others draw on the frame
+        # and get the reduced mask, which costs nothing to hand over.
+        if not getattr(item, 'draws_on_mask', False):
+            mask = self.motion_small
+        elif self.display.due(display.PROCESSED):
+            mask = self.motion_blob
+        else:
+            mask = None
+        item.post_process(self.current_frame, mask)
+
+    def game_state(self):
+        ''' What the recorder's sidecar notes down for every frame. '''
+        state = {'effects' : dict((stage,
+                                   [effect.__class__.__name__ for effect
+                                    in self.scheduler.effects(stage)])
+                                  for stage in scheduler.STAGES)}
+        gc = getattr(self, 'gc', None)
+        if gc is not None:
+            state['score'] = gc.score
+            state['high_score'] = gc.high_score
+        return state
+
+    def recording_fps(self):
+        '''
+        The frame rate of the recording: --record-fps, else the camera frame
+        rate of the profile, else the live window's refresh limit. The
+        recorder keeps the video to the time the frames were made at, so
+        this only sets how finely that time is sampled.
+        '''
+        if RECORD_FPS is not None:
+            return RECORD_FPS
+        if CAMERA_FPS is not None:
+            return CAMERA_FPS
+        if LIVE_FPS is not None:
+            return LIVE_FPS
+        return recorder.DEFAULT_FPS
+
+    def record_frame(self):
+        mask = None
+        if RECORD_MASK:
+            mask = self.motion_blob
+        self.recorder.submit(self.current_frame, mask, self.game_state())
 
     def display_image(self):
-        cv2.imshow("Processed", self.motion_blob)
-        cv2.imshow("Live", self.current_frame)
+        # The full size mask is only built when the window takes it
+        self.display.show(display.PROCESSED, lambda: self.motion_blob)
+        self.display.show(display.LIVE, self.current_frame)
         self.update_interface()
 
     def update_interface(self):
         ch = 0xFF & cv2.waitKey(1) 
+        if ch != 0xFF and self.session is not None:
+            self.session.key(ch)
+        self.handle_key(ch)
+        self.replay_keys()
+
+    def replay_keys(self):
+        # Press the keys the operator pressed after this frame in the session
+        if self.replay_source is None: return
+        for key in self.replay_source.keys_after():
+            self.handle_key(key)
+
+    def handle_key(self, ch):
         if   ch == 27 or ch == ord('q'):
             self.closeEvent()
 
@@ -1065,14 +1447,18 @@ class MainBubbler(QObject):
         elif ch == ord('3'):
             self.log.info("rough test")
             self.roughb = RoughTest(self.rm.reference_color)
-            self.pre_queue.put( self.roughb)
+            self.scheduler.add(scheduler.PRE, self.roughb)
 
         elif ch == ord('r'):
             self.new_reference()
 
         elif ch == ord('f'):
             self.di.enabled = not self.di.enabled
-            self.post_queue.put(self.di)
+            self.scheduler.add(scheduler.POST, self.di)
+
+        elif ch == ord('p'):
+            self.profiler.enabled = not self.profiler.enabled
+            self.scheduler.add(scheduler.POST, self.profiler)
        
         elif ch == ord('n'):
             try:
@@ -1084,12 +1470,125 @@ class MainBubbler(QObject):
 
 if __name__ == '__main__':
     parser = optparse.OptionParser()
+    parser.add_option("--profile", dest="PROFILE", default=profiles.DEFAULT,
+                      choices=sorted(profiles.PROFILES.keys()),
+                      help="resolution, frame rate and effect settings: " +
+                           ", ".join(sorted(profiles.PROFILES.keys())))
+    parser.add_option("--camera", dest="CAMERA", type="int", default=1,
+                      help="camera index (default 1)")
+    parser.add_option("--source", dest="SOURCE",
+                      help="camera index, video file, synth:... or "
+                           "replay:PATH instead of the camera")
     parser.add_option("--debug", action="store_true", dest="DEBUG")
     parser.add_option("--video-only", action="store_true", dest="VIDEO_ONLY")
+    parser.add_option("--no-threaded-capture", action="store_false",
+                      dest="THREADED_CAPTURE", default=True)
+    parser.add_option("--profile-log", dest="PROFILE_LOG", metavar="PATH",
+                      help="write per frame timings to a .csv or .jsonl file")
+    parser.add_option("--motion", dest="MOTION_ENGINE", default="static",
+                      choices=sorted(motion.engines.keys()),
+                      help="motion detection engine: " +
+                           ", ".join(sorted(motion.engines.keys())))
+    parser.add_option("--motion-scale", dest="MOTION_SCALE", type="choice",
+                      choices=["1", "2", "4"],
+                      help="run motion detection at 1/N resolution")
+    parser.add_option("--pipeline-depth", dest="PIPELINE_DEPTH", type="int",
+                      default=0, metavar="N",
+                      help="find motion on a worker thread up to N frames "
+                           "ahead of the game, 0 runs everything in turn")
+    parser.add_option("--offload", dest="OFFLOAD_PROCESSES", type="int",
+                      default=0, metavar="N",
+                      help="run the skeleton and fire effects in N worker "
+                           "processes, one frame behind")
+    parser.add_option("--frame-bus", dest="FRAME_BUS", metavar="PATH",
+                      help="publish composed frames to a shared memory ring "
+                           "at PATH, view with: python framebus.py PATH")
+    parser.add_option("--record", dest="RECORD", metavar="PATH",
+                      help="record the game to a video file, with the game "
+                           "state of every frame in PATH.jsonl")
+    parser.add_option("--record-mask", dest="RECORD_MASK",
+                      action="store_true", default=False,
+                      help="also record the motion mask to PATH_mask")
+    parser.add_option("--record-policy", dest="RECORD_POLICY",
+                      choices=recorder.POLICIES, default=recorder.DROP,
+                      help="when the encoder falls behind: drop frames "
+                           "(default) or block the game")
+    parser.add_option("--record-fps", dest="RECORD_FPS", type="float",
+                      help="frame rate of the recording, default the camera "
+                           "frame rate of the profile")
+    parser.add_option("--record-session", dest="SESSION", metavar="PATH",
+                      help="save the raw frames and key presses for "
+                           "--source replay:PATH")
+    parser.add_option("--session-format", dest="SESSION_FORMAT",
+                      choices=sorted(replay.FORMATS.keys()), default="jpg",
+                      help="jpg (quality 95, default) or png (lossless)")
+    parser.add_option("--skeleton", dest="SKELETON_METHOD", default="morph",
+                      choices=[skeleton.MORPH, skeleton.THINNING],
+                      help="skeleton effect method: morph or thinning")
+    parser.add_option("--skeleton-budget", dest="SKELETON_BUDGET_MS",
+                      type="float", metavar="MS",
+                      help="spread the skeleton over frames, MS per frame")
+    parser.add_option("--mask-change", dest="MASK_CHANGE_FRACTION",
+                      type="float", default=0.01, metavar="FRACTION",
+                      help="recompute skeleton and fire outlines only when "
+                           "this fraction of the motion mask changed")
+    parser.add_option("--mask-refresh", dest="MASK_REFRESH_FRAMES",
+                      type="int", default=30, metavar="FRAMES",
+                      help="recompute them at least every FRAMES frames")
+    parser.add_option("--kiosk", action="store_true", dest="KIOSK",
+                      default=False,
+                      help="show the game window only, no Processed window")
+    parser.add_option("--processed-fps", dest="PROCESSED_FPS", type="float",
+                      metavar="FPS",
+                      help="refresh the Processed window at most FPS times "
+                           "a second")
+    parser.add_option("--live-fps", dest="LIVE_FPS", type="float",
+                      metavar="FPS",
+                      help="refresh the Live window at most FPS times a "
+                           "second")
+    parser.add_option("--renderer", dest="RENDERER", default="software",
+                      choices=["software", "opengl"],
+                      help="draw the bubbles on the CPU (software, default) "
+                           "or with OpenGL in the Live window")
+    parser.add_option("--target-fps", dest="TARGET_FPS", type="float",
+                      metavar="FPS",
+                      help="lower the effect quality step by step while "
+                           "frames take longer than 1/FPS, and raise it "
+                           "again when there is headroom")
     (options,args) = parser.parse_args()
+
+    # The profile first, so the options given override it
+    profiles.apply(options.PROFILE, globals())
+    CAMERA = options.CAMERA
+    SOURCE = options.SOURCE
     DEBUG = options.DEBUG
     VIDEO_ONLY = options.VIDEO_ONLY
+    THREADED_CAPTURE = options.THREADED_CAPTURE
+    PROFILE_LOG = options.PROFILE_LOG
+    MOTION_ENGINE = options.MOTION_ENGINE
+    if options.MOTION_SCALE is not None:
+        MOTION_SCALE = int(options.MOTION_SCALE)
+    PIPELINE_DEPTH = options.PIPELINE_DEPTH
+    OFFLOAD_PROCESSES = options.OFFLOAD_PROCESSES
+    FRAME_BUS = options.FRAME_BUS
+    RECORD = options.RECORD
+    RECORD_MASK = options.RECORD_MASK
+    RECORD_POLICY = options.RECORD_POLICY
+    RECORD_FPS = options.RECORD_FPS
+    SESSION = options.SESSION
+    SESSION_FORMAT = options.SESSION_FORMAT
+    SKELETON_METHOD = options.SKELETON_METHOD
+    if options.SKELETON_BUDGET_MS is not None:
+        SKELETON_BUDGET_MS = options.SKELETON_BUDGET_MS
+    MASK_CHANGE_FRACTION = options.MASK_CHANGE_FRACTION
+    MASK_REFRESH_FRAMES = options.MASK_REFRESH_FRAMES
+    KIOSK = options.KIOSK
+    if options.PROCESSED_FPS is not None:
+        PROCESSED_FPS = options.PROCESSED_FPS
+    LIVE_FPS = options.LIVE_FPS
+    RENDERER = options.RENDERER
+    TARGET_FPS = options.TARGET_FPS
 
     app = QApplication(sys.argv)
-    mb = MainBubbler()
+    mb = MainBubbler(source=SOURCE)
     sys.exit(app.exec_())
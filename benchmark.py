@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+'''
+Headless benchmark for the Bubbler pipeline.
+
+Replays a recorded video or a synthetic source through find_motion and the
+pre/game/post effect stages of a headless MainBubbler, without HighGUI windows
+or a webcam, and reports frames per second plus per stage latency. Random
+numbers are seeded so every run of a scenario sees the same bubbles.
+
+Usage:
+    python -u benchmark.py [--source <video source>] [--frames N]
+                           [--scenario name[,name...]] [--seed N]
+                           [--bubbles N] [--mess-every N] [--warmup N]
+                           [--motion engine[,engine...]] [--motion-scale N]
+                           [--pipeline-depth N] [--offload N]
+                           [--profile name] [--target-fps FPS]
+                           [--json PATH] [--profile-log PATH]
+
+    source is anything video.create_capture accepts: a video file, a camera
+    index or synth:<params>. Frames are resized to the processing size.
+    synth:class=blobs:count=N:speed=N gives a few figures walking through a
+    still room, closer to a venue than the default moving chess board.
+
+    --profile runs at the processing size, bubble settings and effect
+    budgets of one of the profiles in profiles.py. --target-fps turns on the
+    quality governor (see governor.py), which logs every step it takes.
+
+Scenarios:
+    idle      motion detection and the always on effects only
+    bubbles   --bubbles good bubbles falling through the scene
+    mess      a new mess explosion every --mess-every frames
+    smoosher  the smoosher shrink effect active in the pre stage
+    fire      the fire outline effect active in the pre stage
+    skeleton  the skeleton effect active in the pre stage
+    all       every scenario above at once
+
+Every scenario runs once per motion engine given with --motion (see motion.py),
+which also gives the per frame find_motion cost of each engine. With
+--pipeline-depth the motion is found on a worker thread (see pipeline.py) and
+reported as worker:find_motion. --offload runs the skeleton and fire effects
+in worker processes (see offload.py).
+'''
+import os, sys, json, random, optparse
+import numpy
+from PyQt4.QtCore import QCoreApplication
+
+import Bubbler, scheduler, motion, profiles
+from common import clock
+
+DEFAULT_SOURCE = 'synth:class=chess:noise=0.1'
+
+
+class Scenario(object):
+    def __init__(self, options):
+        self.options = options
+
+    def setup(self, mb):
+        pass
+
+    def frame(self, mb, index):
+        pass
+
+
+class Idle(Scenario):
+    pass
+
+
+class Bubbles(Scenario):
+    def setup(self, mb):
+        group = Bubbler.GroupBubbles(mb.compositor, self.options.bubbles)
+        mb.scheduler.add(scheduler.GAME, group)
+
+
+class Mess(Scenario):
+    def frame(self, mb, index):
+        if index % self.options.mess_every == 0:
+            x = random.randrange(0, Bubbler.IMG_WIDTH)
+            y = random.randrange(0, Bubbler.IMG_HEIGHT / 2)
+            mess = Bubbler.MessBubbles(x, y, mb.compositor)
+            mb.scheduler.add(scheduler.GAME, mess)
+
+
+class Smoosher(Scenario):
+    def setup(self, mb):
+        mb.sb = Bubbler.SmoosherBubble(mb.rm.reference_color, mb.timers)
+        mb.sb.preproc_enabled = True
+        mb.scheduler.add(scheduler.PRE, mb.sb)
+
+
+class Skeleton(Scenario):
+    def setup(self, mb):
+        mb.skb = Bubbler.SkeletonBubble(mb.rm.reference_color)
+        mb.scheduler.add(scheduler.PRE, mb.skb)
+
+
+class Fire(Scenario):
+    def setup(self, mb):
+        mb.fb = Bubbler.FireBubble(mb.rm.reference_color)
+        mb.scheduler.add(scheduler.PRE, mb.fb)
+
+
+class All(Scenario):
+    def __init__(self, options):
+        Scenario.__init__(self, options)
+        self.parts = [Class(options) for Class in
+                      (Bubbles, Mess, Smoosher, Fire, Skeleton)]
+
+    def setup(self, mb):
+        for part in self.parts:
+            part.setup(mb)
+
+    def frame(self, mb, index):
+        for part in self.parts:
+            part.frame(mb, index)
+
+
+scenarios = dict(idle=Idle, bubbles=Bubbles, mess=Mess, smoosher=Smoosher,
+                 fire=Fire, skeleton=Skeleton, all=All)
+
+
+def source_for(source):
+    # Synthetic sources have to be generated at the processing size
+    if source.startswith('synth') and 'size=' not in source:
+        source += ':size=%dx%d' % (Bubbler.IMG_WIDTH, Bubbler.IMG_HEIGHT)
+    return source
+
+def run_scenario(app, name, engine, options):
+    Bubbler.MOTION_ENGINE = engine
+    random.seed(options.seed)
+    numpy.random.seed(options.seed)
+
+    mb = Bubbler.MainBubbler(source=source_for(options.source), headless=True)
+    scenario = scenarios[name](options)
+    scenario.setup(mb)
+
+    frames = 0
+    start = None
+    for index in range(options.warmup + options.frames):
+        if index == options.warmup:
+            mb.profiler.reset()
+            start = clock()
+
+        scenario.frame(mb, index)
+        if not mb.process_frame():
+            print 'Source ended after', index, 'frames'
+            break
+        mb.profiler.end_frame()
+        mb.govern()
+
+        # Deliver queued Qt events, as the event loop would
+        app.processEvents()
+        if index >= options.warmup:
+            frames += 1
+
+    elapsed = 0.0
+    if start is not None:
+        elapsed = clock() - start
+    mb.closeEvent()
+
+    result = dict(scenario=name, motion=engine, frames=frames, seconds=elapsed,
+                  fps=frames / elapsed if elapsed > 0 else 0.0,
+                  sections=[dict(name=section, p50=p50, p95=p95, p99=p99)
+                            for section, p50, p95, p99
+                            in mb.profiler.summary()])
+    return result
+
+def print_result(result):
+    print
+    print '%s (%s motion): %d frames in %0.2f s, %0.1f fps' % (
+            result['scenario'], result['motion'], result['frames'],
+            result['seconds'], result['fps'])
+    print '    %-26s %8s %8s %8s' % ('section (ms)', 'p50', 'p95', 'p99')
+    for section in result['sections']:
+        print '    %-26s %8.2f %8.2f %8.2f' % (section['name'][:26],
+                section['p50'], section['p95'], section['p99'])
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option("--source", default=DEFAULT_SOURCE)
+    parser.add_option("--frames", type="int", default=300)
+    parser.add_option("--warmup", type="int", default=10)
+    parser.add_option("--scenario", default="idle,bubbles,mess,smoosher,"
+                                            "fire,skeleton,all")
+    parser.add_option("--seed", type="int", default=1)
+    parser.add_option("--bubbles", type="int", default=100)
+    parser.add_option("--mess-every", type="int", dest="mess_every",
+                      default=30)
+    parser.add_option("--motion", default="static")
+    parser.add_option("--motion-scale", type="int", dest="motion_scale")
+    parser.add_option("--profile", default=profiles.DEFAULT,
+                      choices=sorted(profiles.PROFILES.keys()))
+    parser.add_option("--pipeline-depth", type="int", dest="pipeline_depth",
+                      default=0)
+    parser.add_option("--offload", type="int", default=0)
+    parser.add_option("--target-fps", type="float", dest="target_fps")
+    parser.add_option("--json", dest="json_path", metavar="PATH")
+    parser.add_option("--profile-log", dest="profile_log", metavar="PATH")
+    (options, args) = parser.parse_args()
+
+    # Replay frames in order, never drop them on a capture thread
+    Bubbler.THREADED_CAPTURE = False
+    profiles.apply(options.profile, vars(Bubbler))
+    if options.motion_scale is not None:
+        Bubbler.MOTION_SCALE = options.motion_scale
+    Bubbler.PIPELINE_DEPTH = options.pipeline_depth
+    Bubbler.OFFLOAD_PROCESSES = options.offload
+    Bubbler.TARGET_FPS = options.target_fps
+
+    app = QCoreApplication(sys.argv)
+    results = []
+    for engine in options.motion.split(','):
+        if engine not in motion.engines:
+            parser.error('Unknown motion engine: ' + engine)
+
+        for name in options.scenario.split(','):
+            if name not in scenarios:
+                parser.error('Unknown scenario: ' + name)
+
+            # One timing log per run, next to the requested path
+            if options.profile_log:
+                root, ext = os.path.splitext(options.profile_log)
+                Bubbler.PROFILE_LOG = root + '_' + name + '_' + engine + ext
+
+            result = run_scenario(app, name, engine, options)
+            print_result(result)
+            results.append(result)
+
+    if options.json_path:
+        with open(options.json_path, 'w') as out:
+            json.dump(results, out, indent=2)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+'''
+Background frame acquisition for the Bubbler.
+
+The capture objects returned by video.create_capture block in read() until the
+driver hands over the next frame, which caps the game loop at the camera rate
+and adds the USB latency to every frame. CaptureThread moves that wait onto a
+daemon thread. The thread fills a small ring of preallocated frames and read()
+hands back the newest complete one. Frames the main loop never got around to
+are overwritten instead of queued, so the game always works on the freshest
+view of the room while the next frame is being grabbed.
+'''
+import logging, threading
+import numpy
+
+
+class CaptureThread(object):
+    def __init__(self, cam, ring_size=3, timeout=1.0):
+        self.log = logging.getLogger()
+        self.cam = cam
+        self.timeout = timeout
+
+        # Three slots is the minimum: one held by the main loop, one holding
+        # the newest complete frame and one being written by the thread
+        if ring_size < 3: ring_size = 3
+
+        ret, first = self.cam.read()
+        if not ret:
+            raise IOError("Unable to read the first frame from the camera")
+
+        self.slots = [numpy.empty_like(first) for i in range(ring_size)]
+        numpy.copyto(self.slots[0], first)
+
+        self.latest = 0     # Slot with the newest complete frame
+        self.reading = None # Slot currently handed to the main loop
+        self.sequence = 1   # Count of frames grabbed
+        self.delivered = 0  # Sequence number of the last frame handed out
+        self.dropped = 0    # Frames overwritten before anyone read them
+        self.failures = 0
+
+        self.cond = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="CaptureThread")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def free_slot(self):
+        for idx in range(len(self.slots)):
+            if idx != self.latest and idx != self.reading:
+                return idx
+
+    def grab(self, slot):
+        ret, img = self.cam.read(slot)
+        if not ret or img is None:
+            return False
+
+        # Not every source writes into the supplied buffer, copy it over so
+        # the ring stays preallocated
+        if img is not slot:
+            if img.shape != slot.shape or img.dtype != slot.dtype:
+                return False
+            numpy.copyto(slot, img)
+        return True
+
+    def run(self):
+        while self.running:
+            with self.cond:
+                idx = self.free_slot()
+
+            if not self.grab(self.slots[idx]):
+                self.failures += 1
+                if self.failures % 100 == 1:
+                    self.log.warn("Capture thread read failure " +
+                                  str(self.failures))
+                continue
+
+            with self.cond:
+                if self.delivered < self.sequence:
+                    self.dropped += 1
+                self.latest = idx
+                self.sequence += 1
+                self.cond.notify_all()
+
+    def read(self, dst=None):
+        '''
+        Return the newest frame, waiting only when the main loop has already
+        seen every frame grabbed so far. The returned array belongs to the ring
+        and is only valid until the next call to read(); copy it (or flip it
+        into a new array as MainBubbler does) if it needs to live longer.
+        '''
+        with self.cond:
+            if self.delivered >= self.sequence:
+                self.cond.wait(self.timeout)
+            if self.delivered >= self.sequence:
+                return False, None
+
+            self.reading = self.latest
+            self.delivered = self.sequence
+            frame = self.slots[self.reading]
+
+        if dst is not None:
+            numpy.copyto(dst, frame)
+            return True, dst
+        return True, frame
+
+    def isOpened(self):
+        return self.running and self.cam.isOpened()
+
+    def stop(self):
+        self.running = False
+        self.thread.join(self.timeout)
+
+    def release(self):
+        self.stop()
+        if hasattr(self.cam, 'release'):
+            self.cam.release()
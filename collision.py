@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+'''
+Collision tests between bubbles and the motion mask.
+
+Every test reduces a single slice of the mask with one OpenCV call, so the cost
+of a check no longer grows with the square of the bubble radius the way the old
+per pixel loops did. The hit policy decides how much of the bubble has to touch
+motion before it counts as popped:
+
+    center   - motion at the exact center pixel (the original bubble check)
+    square   - any motion in a square inscribed in the circle (the original
+               bad bubble check)
+    disc     - any motion anywhere inside the circle
+    coverage - at least min_fraction of the circle is covered by motion
+
+Bubbles with their center off screen never collide, which lets new bubbles
+drift in from above the top edge without popping.
+
+CollisionIndex is built once per frame from the motion mask. It keeps a summed
+area table (cv2.integral) of the thresholded mask so every region test is four
+lookups regardless of the bubble size, and hits() tests arrays of bubbles in a
+single NumPy call. The index approximates the circle with rectangles that lie
+inside it: the disc policy checks the inscribed square plus a horizontal and a
+vertical band, and the coverage policy measures the inscribed square. An index
+built from a reduced resolution motion mask takes the scale factor and maps
+the full frame bubble coordinates into the small mask. When the motion engine
+knows that motion can only be inside some bounds, the table covers just those
+bounds, and nothing at all is built for a frame without motion.
+'''
+import cv2
+import numpy
+
+CENTER   = 'center'
+SQUARE   = 'square'
+DISC     = 'disc'
+COVERAGE = 'coverage'
+
+MOTION_THRESHOLD = 1
+
+# Circle stencils are reused for every bubble of the same radius
+_disc_cache = {}
+
+def disc_stencil(radius):
+    stencil = _disc_cache.get(radius)
+    if stencil is None:
+        size = 2 * radius + 1
+        stencil = numpy.zeros((size, size), numpy.uint8)
+        cv2.circle(stencil, (radius, radius), radius, 255, thickness=-1)
+        _disc_cache[radius] = stencil
+    return stencil
+
+def clip_box(mask, x, y, half):
+    ''' Return the (start_y, end_y, start_x, end_x) box of the given half size
+    around x, y, clipped to the mask. '''
+    height, width = mask.shape[:2]
+    start_y = max(y - half, 0)
+    end_y   = min(y + half + 1, height)
+    start_x = max(x - half, 0)
+    end_x   = min(x + half + 1, width)
+    return start_y, end_y, start_x, end_x
+
+def inscribed_half(radius):
+    # Keep the square comfortably inside the circle, as the bad bubble always
+    # has
+    return radius - (radius // 4)
+
+def center_hit(mask, x, y, radius):
+    return mask.item(y, x) > MOTION_THRESHOLD
+
+def square_hit(mask, x, y, radius):
+    # Like the old bad bubble loop the far edges are left out of the square
+    half = inscribed_half(radius)
+    sy, ey, sx, ex = clip_box(mask, x, y, half)
+    ey = min(ey, y + half)
+    ex = min(ex, x + half)
+    if sy >= ey or sx >= ex: return False
+    return mask[sy:ey, sx:ex].max() > MOTION_THRESHOLD
+
+def _disc_region(mask, x, y, radius):
+    sy, ey, sx, ex = clip_box(mask, x, y, radius)
+    stencil = disc_stencil(radius)
+    # Clip the stencil by the same amount the mask region was clipped
+    oy = sy - (y - radius)
+    ox = sx - (x - radius)
+    return mask[sy:ey, sx:ex], stencil[oy:oy + (ey - sy), ox:ox + (ex - sx)]
+
+def disc_hit(mask, x, y, radius):
+    region, stencil = _disc_region(mask, x, y, radius)
+    if region.size == 0: return False
+    min_val, max_val, min_loc, max_loc = cv2.minMaxLoc(region, stencil)
+    return max_val > MOTION_THRESHOLD
+
+def coverage_fraction(mask, x, y, radius):
+    region, stencil = _disc_region(mask, x, y, radius)
+    total = cv2.countNonZero(stencil)
+    if total == 0: return 0.0
+    ret, moving = cv2.threshold(region, MOTION_THRESHOLD, 255,
+                                cv2.THRESH_BINARY)
+    cv2.bitwise_and(moving, stencil, moving)
+    return float(cv2.countNonZero(moving)) / total
+
+def coverage_hit(mask, x, y, radius, min_fraction=0.25):
+    return coverage_fraction(mask, x, y, radius) >= min_fraction
+
+POLICIES = {
+    CENTER : center_hit,
+    SQUARE : square_hit,
+    DISC   : disc_hit,
+}
+
+def pop_check(mask, x, y, radius, policy=CENTER, min_fraction=0.25):
+    '''
+    Return 1 if the bubble at x, y collides with motion, 0 otherwise. The mask
+    can be the motion image itself or the CollisionIndex built from it.
+    '''
+    if isinstance(mask, CollisionIndex):
+        return mask.pop_check(x, y, radius, policy, min_fraction)
+
+    height, width = mask.shape[:2]
+    if y <= 0 or y >= height : return 0
+    if x <= 0 or x >= width : return 0
+
+    radius = max(int(radius), 0)
+    if policy == COVERAGE:
+        hit = coverage_hit(mask, x, y, radius, min_fraction)
+    else:
+        hit = POLICIES[policy](mask, x, y, radius)
+
+    if hit:
+        return 1
+    return 0
+
+
+# Fractions of the radius for the rectangles used to approximate the circle.
+# The bands are (0.92, 0.38) so their corners stay inside the circle.
+SQUARE_FRACTION = 0.707
+BAND_LONG  = 0.92
+BAND_SHORT = 0.38
+
+class CollisionIndex(object):
+    def __init__(self, mask, scale=1, bounds=None):
+        self.mask = mask
+        self.scale = scale
+        self.height, self.width = mask.shape[:2]
+
+        # Size of the frame the bubble coordinates are in
+        self.frame_height = self.height * scale
+        self.frame_width = self.width * scale
+
+        # The mask is zero outside the bounds (x0, y0, x1, y1)
+        if bounds is None:
+            bounds = (0, 0, self.width, self.height)
+        self.x0, self.y0, x1, y1 = bounds
+        self.sum_width = max(x1 - self.x0, 0)
+        self.sum_height = max(y1 - self.y0, 0)
+
+        self.sums = None
+        if self.sum_width and self.sum_height:
+            region = mask[self.y0:y1, self.x0:x1]
+            ret, binary = cv2.threshold(region, MOTION_THRESHOLD, 1,
+                                        cv2.THRESH_BINARY)
+            self.sums = cv2.integral(binary)
+
+    def box_sums(self, xs, ys, half_w, half_h):
+        '''
+        Count the motion pixels in the boxes centered on xs, ys with the given
+        half sizes. All arguments are arrays (or scalars) of the same shape.
+        '''
+        return self.range_sums(xs - half_w, xs + half_w + 1,
+                               ys - half_h, ys + half_h + 1)
+
+    def range_sums(self, sx, ex, sy, ey):
+        '''
+        Count the motion pixels in the boxes from sx, sy up to but not
+        including ex, ey, in mask coordinates.
+        '''
+        if self.sums is None:
+            return numpy.zeros(numpy.broadcast(sx, sy).shape, numpy.int32)
+        sx = numpy.clip(sx - self.x0, 0, self.sum_width)
+        ex = numpy.clip(ex - self.x0, 0, self.sum_width)
+        sy = numpy.clip(sy - self.y0, 0, self.sum_height)
+        ey = numpy.clip(ey - self.y0, 0, self.sum_height)
+        sums = self.sums
+        return sums[ey, ex] - sums[sy, ex] - sums[ey, sx] + sums[sy, sx]
+
+    def box_areas(self, xs, ys, half_w, half_h):
+        sx = numpy.clip(xs - half_w, 0, self.width)
+        ex = numpy.clip(xs + half_w + 1, 0, self.width)
+        sy = numpy.clip(ys - half_h, 0, self.height)
+        ey = numpy.clip(ys + half_h + 1, 0, self.height)
+        return (ex - sx) * (ey - sy)
+
+    def hits(self, xs, ys, radii, policy=CENTER, min_fraction=0.25):
+        '''
+        Test every bubble in one pass. Takes arrays of x, y and radius and
+        returns an array of booleans, True where the bubble collides.
+        '''
+        xs = numpy.asarray(xs, numpy.int32)
+        ys = numpy.asarray(ys, numpy.int32)
+        radii = numpy.asarray(radii, numpy.float32)
+        on_screen = ((xs > 0) & (xs < self.frame_width) &
+                     (ys > 0) & (ys < self.frame_height))
+
+        if self.scale != 1:
+            xs = xs // self.scale
+            ys = ys // self.scale
+            radii = radii / self.scale
+
+        if policy == CENTER:
+            zero = numpy.zeros_like(xs)
+            counts = self.box_sums(xs, ys, zero, zero)
+
+        elif policy == SQUARE:
+            half = radii.astype(numpy.int32)
+            half = half - half // 4
+            # The far edges are left out, see square_hit
+            counts = self.range_sums(xs - half, xs + half, ys - half,
+                                     ys + half)
+
+        elif policy == DISC:
+            half = (radii * SQUARE_FRACTION).astype(numpy.int32)
+            long_half = (radii * BAND_LONG).astype(numpy.int32)
+            short_half = (radii * BAND_SHORT).astype(numpy.int32)
+            counts = (self.box_sums(xs, ys, half, half) +
+                      self.box_sums(xs, ys, long_half, short_half) +
+                      self.box_sums(xs, ys, short_half, long_half))
+
+        elif policy == COVERAGE:
+            half = (radii * SQUARE_FRACTION).astype(numpy.int32)
+            counts = self.box_sums(xs, ys, half, half)
+            areas = self.box_areas(xs, ys, half, half)
+            return on_screen & (counts >= min_fraction * areas)
+
+        else:
+            raise KeyError(policy)
+
+        return on_screen & (counts > 0)
+
+    def pop_check(self, x, y, radius, policy=CENTER, min_fraction=0.25):
+        if y <= 0 or y >= self.frame_height : return 0
+        if x <= 0 or x >= self.frame_width : return 0
+
+        hit = self.hits([x], [y], [radius], policy, min_fraction)[0]
+        if hit:
+            return 1
+        return 0
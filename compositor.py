@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+'''
+Shared translucent overlay for every effect in a frame.
+
+Translucent effects used to copy the whole frame, draw on the copy and
+cv2.addWeighted it back, which costs two full frame passes per effect no matter
+how little was drawn. OverlayCompositor is owned by MainBubbler and keeps one
+reusable color buffer plus an alpha channel. Effects draw into it during the
+game stage and record the rectangles they touched. composite() then blends
+only those dirty rectangles into the frame, once per frame, and clears them for
+the next one. The cost of translucency follows the area drawn, not the number
+of effects.
+
+Opaque bubbles are drawn straight into the frame, but also go through the
+compositor (opaque_circle, opaque_circles) so that a rendering backend can
+take them over, see glrender.py.
+'''
+import cv2
+import numpy
+
+
+class OverlayCompositor(object):
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.overlay = numpy.zeros((height, width, 3), numpy.uint8)
+        self.alpha = numpy.zeros((height, width), numpy.uint8)
+        self.dirty = []
+
+        # The quality governor can turn anti-aliasing off
+        self.line_type = cv2.CV_AA
+
+    def add_dirty(self, x0, y0, x1, y1):
+        x0 = max(x0, 0)
+        y0 = max(y0, 0)
+        x1 = min(x1, self.width)
+        y1 = min(y1, self.height)
+        if x0 < x1 and y0 < y1:
+            self.dirty.append((x0, y0, x1, y1))
+
+    def circle(self, center, radius, color, opacity, thickness=-1):
+        alpha = int(round(opacity * 255))
+        if alpha <= 0 or radius <= 0: return
+        x, y = center
+
+        # The alpha channel carries the anti-aliasing so the color can be
+        # drawn solid without dark fringes
+        cv2.circle(self.overlay, center, radius, color, thickness=thickness)
+        cv2.circle(self.alpha, center, radius, alpha, thickness=thickness,
+                   lineType=self.line_type)
+        self.add_dirty(x - radius - 1, y - radius - 1,
+                       x + radius + 2, y + radius + 2)
+
+    def circles(self, xs, ys, radii, color, opacity, thickness=-1):
+        for x, y, r in zip(numpy.asarray(xs).tolist(),
+                           numpy.asarray(ys).tolist(),
+                           numpy.asarray(radii).tolist()):
+            self.circle((x, y), r, color, opacity, thickness)
+
+    def opaque_circle(self, dst, center, radius, color, thickness=-1):
+        cv2.circle(dst, center, radius, color, thickness=thickness,
+                   lineType=self.line_type)
+
+    def opaque_circles(self, dst, xs, ys, radii, color, thickness=-1):
+        for x, y, r in zip(numpy.asarray(xs).tolist(),
+                           numpy.asarray(ys).tolist(),
+                           numpy.asarray(radii).tolist()):
+            cv2.circle(dst, (x, y), r, color, thickness=thickness,
+                       lineType=self.line_type)
+
+    def merged_dirty(self):
+        ''' Merge overlapping dirty rectangles so no pixel is blended twice. '''
+        rects = sorted(self.dirty)
+        merged = True
+        while merged:
+            merged = False
+            out = []
+            for rect in rects:
+                for idx, other in enumerate(out):
+                    if (rect[0] < other[2] and other[0] < rect[2] and
+                        rect[1] < other[3] and other[1] < rect[3]):
+                        out[idx] = (min(rect[0], other[0]),
+                                    min(rect[1], other[1]),
+                                    max(rect[2], other[2]),
+                                    max(rect[3], other[3]))
+                        merged = True
+                        break
+                else:
+                    out.append(rect)
+            rects = out
+        return rects
+
+    def composite(self, dst):
+        for x0, y0, x1, y1 in self.merged_dirty():
+            alpha = self.alpha[y0:y1, x0:x1]
+            over = self.overlay[y0:y1, x0:x1]
+            back = dst[y0:y1, x0:x1]
+
+            # Some pre effects (the skeleton) replace the frame with a single
+            # channel image
+            if back.ndim == 2:
+                blend_over = cv2.cvtColor(over, cv2.COLOR_BGR2GRAY)
+                blend_alpha = alpha.copy()
+            else:
+                blend_over = over
+                blend_alpha = cv2.cvtColor(alpha, cv2.COLOR_GRAY2BGR)
+
+            # back = back * (1 - alpha) + over * alpha, as in
+            # http://bistr-o-mathik.org/2012/06/13/simple-transparency-in-opencv/
+            # but per pixel and only inside the rectangle
+            cv2.multiply(blend_over, blend_alpha, blend_over, scale=1/255.0)
+            cv2.bitwise_not(blend_alpha, blend_alpha)
+            cv2.multiply(back, blend_alpha, back, scale=1/255.0)
+            cv2.add(back, blend_over, back)
+
+            alpha.fill(0)
+            over.fill(0)
+
+        self.dirty = []
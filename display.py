@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+'''
+HighGUI windows for the Bubbler.
+
+Every cv2.imshow converts and copies the whole image into the window, so
+pushing the 800x600 "Processed" mask on every frame costs about as much as
+the "Live" frame although on a big screen setup hardly anyone looks at it.
+Display keeps per window settings:
+
+    max_fps   show at most this many frames per second, the frames in
+              between are not pushed to the window at all (None: every frame)
+    enabled   False never creates the window, which is what kiosk mode does
+              with "Processed"
+    renderer  draws the window instead of cv2.imshow, see glrender.py
+
+and times every push, so the profiler shows display:<window> per frame and
+the savings of a lower refresh rate can be read off directly. The image can
+be given as a function that makes it, which is only called when the window
+is enabled and due, so a frame that is not shown is not built either.
+
+cv2.imshow has no way to update part of a window, with or without
+WINDOW_OPENGL: the whole image is uploaded every time. Uploading only the
+changed regions needs a window that draws its own texture, like the OpenGL
+renderer.
+'''
+from common import clock
+import cv2
+
+PROCESSED = "Processed"
+LIVE = "Live"
+
+
+class Window(object):
+    def __init__(self, name, flags=cv2.WINDOW_AUTOSIZE, position=None,
+                 max_fps=None, enabled=True, renderer=None):
+        self.name = name
+        self.flags = flags
+        self.position = position
+        self.max_fps = max_fps
+        self.enabled = enabled
+        self.renderer = renderer
+        self.last_shown = None
+        self.shown = 0      # Frames pushed to the window
+        self.skipped = 0    # Frames left out by the refresh limit
+        self.created = False
+
+    def create(self):
+        if not self.enabled or self.created: return
+        cv2.namedWindow(self.name, self.flags)
+        if self.position is not None:
+            cv2.moveWindow(self.name, *self.position)
+        self.created = True
+
+    def due(self, now):
+        if not self.enabled:
+            return False
+        if self.max_fps is None or self.last_shown is None:
+            return True
+        return now - self.last_shown >= 1.0 / self.max_fps
+
+    def show(self, img, now=None):
+        '''
+        Push the image (or what the function img returns) if the window is
+        due, returns True if it was.
+        '''
+        if now is None:
+            now = clock()
+        if not self.due(now):
+            if self.enabled:
+                self.skipped += 1
+            return False
+        if callable(img):
+            img = img()
+        if self.renderer is not None:
+            self.renderer.show(img)
+        else:
+            cv2.imshow(self.name, img)
+        self.last_shown = now
+        self.shown += 1
+        return True
+
+
+class Display(object):
+    def __init__(self, profiler=None):
+        self.windows = []
+        self.profiler = profiler
+
+    def add(self, window):
+        window.create()
+        self.windows.append(window)
+        return window
+
+    def window(self, name):
+        for window in self.windows:
+            if window.name == name:
+                return window
+        return None
+
+    def due(self, name):
+        ''' True if the named window would show a frame pushed now. '''
+        window = self.window(name)
+        return window is not None and window.due(clock())
+
+    def show(self, name, img):
+        window = self.window(name)
+        if window is None or not window.enabled:
+            return False
+        if self.profiler is None:
+            return window.show(img)
+        with self.profiler.section('display:' + name):
+            return window.show(img)
+
+    def summary(self):
+        return ", ".join(window.name + " showed " + str(window.shown) +
+                         " skipped " + str(window.skipped)
+                         for window in self.windows if window.enabled)
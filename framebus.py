@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+'''
+Shared memory frame bus for the Bubbler.
+
+The Bubbler publishes every composed frame once into a ring of slots in a
+memory mapped file, and any number of local processes (a projector window, a
+recorder, an operator monitor) map the same file and look at the frames in
+place. Publishing costs one frame copy however many viewers are attached,
+and viewers never talk to the game process.
+
+Every slot carries a sequence number in the style of a seqlock: the writer
+makes it odd while it copies the frame in and even (twice the frame number)
+when the frame is complete. A reader takes the newest frame, uses the pixels
+straight out of the mapping and then asks valid() whether the slot was
+overwritten while it was looking. With the default eight slots a viewer has
+seven frame times to finish before that can happen.
+
+File layout, all fields little endian 64 bit words:
+    header  magic, version, slot count, width, height, channels, latest frame
+    slots   per slot: sequence, frame number, timestamp (float), channels,
+            then width * height * channels bytes of pixels
+
+Usage of the sample viewer:
+    python framebus.py <bus path> [--window name]
+'''
+import mmap, optparse, time
+import numpy
+
+MAGIC = 0x315355424C425542  # "BUBLBUS1" in little endian
+VERSION = 1
+HEADER_WORDS = 8
+SLOT_HEADER = 64
+ALIGN = 64
+
+# Header word indexes
+H_MAGIC, H_VERSION, H_SLOTS, H_WIDTH, H_HEIGHT, H_CHANNELS, H_LATEST = range(7)
+
+
+def aligned(size):
+    return (size + ALIGN - 1) // ALIGN * ALIGN
+
+
+class Layout(object):
+    def __init__(self, slots, width, height, channels):
+        self.slots = slots
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.frame_bytes = width * height * channels
+        self.slot_bytes = SLOT_HEADER + aligned(self.frame_bytes)
+        self.first_slot = aligned(HEADER_WORDS * 8)
+        self.size = self.first_slot + slots * self.slot_bytes
+
+    def slot_offset(self, idx):
+        return self.first_slot + idx * self.slot_bytes
+
+
+class SlotView(object):
+    ''' NumPy views of one slot's header words and pixels. '''
+    def __init__(self, buf, layout, idx):
+        offset = layout.slot_offset(idx)
+        self.words = numpy.frombuffer(buf, numpy.uint64, 4, offset)
+        self.stamp = numpy.frombuffer(buf, numpy.float64, 1, offset + 16)
+        self.pixels = numpy.frombuffer(buf, numpy.uint8, layout.frame_bytes,
+                                       offset + SLOT_HEADER)
+        self.layout = layout
+
+    def image(self, channels):
+        shape = (self.layout.height, self.layout.width)
+        if channels > 1:
+            shape += (channels,)
+        size = self.layout.width * self.layout.height * channels
+        return self.pixels[:size].reshape(shape)
+
+
+class FrameBus(object):
+    ''' The publishing side. Creates (or truncates) the bus file. '''
+    def __init__(self, path, width, height, slots=8, channels=3):
+        self.path = path
+        self.layout = Layout(slots, width, height, channels)
+
+        self.file = open(path, 'w+b')
+        self.file.truncate(self.layout.size)
+        self.map = mmap.mmap(self.file.fileno(), self.layout.size)
+
+        self.header = numpy.frombuffer(self.map, numpy.uint64, HEADER_WORDS)
+        self.slots = [SlotView(self.map, self.layout, idx)
+                      for idx in range(slots)]
+        self.sequence = 0
+
+        self.header[H_LATEST] = 0
+        self.header[H_VERSION] = VERSION
+        self.header[H_SLOTS] = slots
+        self.header[H_WIDTH] = width
+        self.header[H_HEIGHT] = height
+        self.header[H_CHANNELS] = channels
+        self.header[H_MAGIC] = MAGIC
+
+    def publish(self, frame):
+        # Frames still coming in after close() go nowhere
+        if self.header is None: return
+        channels = 1 if frame.ndim == 2 else frame.shape[2]
+        if (frame.shape[0] != self.layout.height or
+                frame.shape[1] != self.layout.width or
+                channels > self.layout.channels):
+            raise ValueError("Frame of shape " + str(frame.shape) +
+                             " does not fit the frame bus")
+
+        self.sequence += 1
+        slot = self.slots[self.sequence % self.layout.slots]
+        slot.words[0] = 2 * self.sequence - 1
+        numpy.copyto(slot.image(channels), frame)
+        slot.words[1] = self.sequence
+        slot.stamp[0] = time.time()
+        slot.words[3] = channels
+        slot.words[0] = 2 * self.sequence
+        self.header[H_LATEST] = self.sequence
+
+    def close(self):
+        self.header = None
+        self.slots = []
+        self.map.close()
+        self.file.close()
+
+
+class FrameBusReader(object):
+    ''' The consuming side, any number of these can map the same bus. '''
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = numpy.frombuffer(self.map, numpy.uint64, HEADER_WORDS)
+        if self.header[H_MAGIC] != MAGIC:
+            raise IOError(path + " is not a Bubbler frame bus")
+
+        self.layout = Layout(int(self.header[H_SLOTS]),
+                             int(self.header[H_WIDTH]),
+                             int(self.header[H_HEIGHT]),
+                             int(self.header[H_CHANNELS]))
+        self.slots = [SlotView(self.map, self.layout, idx)
+                      for idx in range(self.layout.slots)]
+        self.last = 0
+        self.missed = 0
+
+    def read(self):
+        '''
+        Return (frame number, image) for the newest frame, or (None, None)
+        when there is nothing new. The image is a view straight into the
+        bus; check valid(frame number) once done with it.
+        '''
+        latest = int(self.header[H_LATEST])
+        if latest == 0 or latest == self.last:
+            return None, None
+
+        slot = self.slots[latest % self.layout.slots]
+        if int(slot.words[0]) != 2 * latest:
+            # Already being overwritten, the next call gets a newer frame
+            return None, None
+
+        if self.last:
+            self.missed += latest - self.last - 1
+        self.last = latest
+        return latest, slot.image(int(slot.words[3]))
+
+    def valid(self, number):
+        ''' True if the frame was not overwritten while it was being used. '''
+        slot = self.slots[number % self.layout.slots]
+        return int(slot.words[0]) == 2 * number
+
+    def close(self):
+        self.header = None
+        self.slots = []
+        self.map.close()
+        self.file.close()
+
+
+if __name__ == '__main__':
+    import cv2
+
+    parser = optparse.OptionParser(usage="%prog <bus path> [--window name]")
+    parser.add_option("--window", default="Bubbler frame bus")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Give the path of the frame bus")
+
+    reader = FrameBusReader(args[0])
+    cv2.namedWindow(options.window)
+    torn = 0
+    while True:
+        number, image = reader.read()
+        if number is not None:
+            cv2.imshow(options.window, image)
+            if not reader.valid(number):
+                torn += 1
+
+        ch = 0xFF & cv2.waitKey(5)
+        if ch == 27 or ch == ord('q'):
+            break
+
+    print 'Missed', reader.missed, 'frames, showed', torn, 'torn frames'
+    reader.close()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+'''
+Game timers that run on frame time.
+
+The reference grab, the start of the game, the countdown, the game clock and
+the power-up timers used to be QTimers, which fire on the wall clock whenever
+Qt gets round to them. A replayed session (see replay.py) hands out the same
+frames as the live game did, but the QTimers fired between other frames: the
+reference came from a different frame, the game started and ended on
+different frames and the random numbers were drawn in a different order.
+
+FrameTimers keeps the game's timers itself and fires them between frames, by
+the time stamp of the frame about to be processed. That is the time the
+frame was recorded at when a session is being recorded or replayed, and the
+clock when the frame was read otherwise. Live play and its replay therefore
+fire every timer before the same frame and in the same order, whatever
+the replay timing. Timers that come due together fire in the order of their
+due times, then in the order they were started. A timer started from a
+timer callback counts from the due time of that callback, so chained one
+second steps (the countdown) do not drift with the frame rate.
+
+FrameTimer has the part of the QTimer interface the game uses (setSingleShot,
+timeout.connect, start, stop, isActive), and single_shot() takes the place of
+QTimer.singleShot.
+'''
+import heapq, itertools
+
+
+class Signal(object):
+    def __init__(self):
+        self.slots = []
+
+    def connect(self, slot):
+        self.slots.append(slot)
+
+    def emit(self):
+        for slot in list(self.slots):
+            slot()
+
+
+class FrameTimers(object):
+    def __init__(self):
+        self.now = 0.0
+        self.queue = []
+        self.counter = itertools.count()
+
+    def schedule(self, msec, callback):
+        entry = [self.now + msec / 1000.0, next(self.counter), callback]
+        heapq.heappush(self.queue, entry)
+        return entry
+
+    def cancel(self, entry):
+        entry[2] = None
+
+    def single_shot(self, msec, callback):
+        self.schedule(msec, callback)
+
+    def advance(self, now):
+        ''' Fire, earliest first, every timer due by now (in seconds). '''
+        while self.queue and self.queue[0][0] <= now:
+            due, order, callback = heapq.heappop(self.queue)
+            if callback is None:
+                continue
+            self.now = due
+            callback()
+        self.now = max(self.now, now)
+
+
+class FrameTimer(object):
+    def __init__(self, timers):
+        self.timers = timers
+        self.timeout = Signal()
+        self.single_shot = False
+        self.interval = 0
+        self.entry = None
+
+    def setSingleShot(self, single_shot):
+        self.single_shot = single_shot
+
+    def start(self, msec):
+        self.stop()
+        self.interval = msec
+        self.entry = self.timers.schedule(msec, self.fire)
+
+    def stop(self):
+        if self.entry is not None:
+            self.timers.cancel(self.entry)
+            self.entry = None
+
+    def isActive(self):
+        return self.entry is not None
+
+    def fire(self):
+        self.entry = None
+        if not self.single_shot:
+            # At least 1 ms, so a repeating timer cannot fire forever in one
+            # advance
+            self.entry = self.timers.schedule(max(self.interval, 1),
+                                              self.fire)
+        self.timeout.emit()
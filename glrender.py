@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+'''
+OpenGL rendering backend for the "Live" window.
+
+With the software path every bubble is an anti-aliased cv2.circle into the
+frame and the translucent mess is blended in by the compositor on the CPU.
+With this backend the frame (camera image and pre effects, still drawn on
+the CPU) is uploaded once per frame into a texture, and the bubbles are drawn
+on top as GPU triangles. GLCompositor records the circles the effects ask for
+instead of drawing them and turns each frame's circles into one vertex array
+per layer (opaque, then translucent), built with NumPy, which GLRenderer
+draws with one glDrawArrays call each. Edges get a one pixel alpha ramp in
+place of OpenCV's anti-aliasing.
+
+The HUD text has to end up over the bubbles, as it does when the post
+overlays draw on the finished frame. GLSpriteCache records the text sprites
+drawn on the composited frame instead of blitting them, and GLRenderer draws
+them last, as textured quads with their premultiplied alpha.
+
+The drawing happens in the cv2.setOpenGlDrawCallback callback of the window,
+which HighGUI runs from cv2.updateWindow. It needs PyOpenGL and an OpenCV
+built with OpenGL support; available() says whether both are there, and the
+Bubbler falls back to the software path when they are not. Only the fixed
+function pipeline and client side arrays are used, so it also runs under
+Mesa's software renderer (LIBGL_ALWAYS_SOFTWARE=1) for testing.
+
+Differences from the software path:
+    overlapping mess drops blend twice instead of once
+    the frame bus and the recorder never see the bubbles, so the Bubbler
+    keeps the software path when either is on
+'''
+import math
+import cv2
+import numpy
+
+try:
+    from OpenGL import GL
+except ImportError:
+    GL = None
+
+import compositor, sprites
+
+# Triangles per circle are picked from the largest radius in a batch
+MIN_SEGMENTS = 12
+MAX_SEGMENTS = 96
+SEGMENT_LENGTH = 4.0
+
+
+def available():
+    return GL is not None and hasattr(cv2, 'setOpenGlDrawCallback')
+
+
+def segments_for(radius):
+    count = int(2 * math.pi * radius / SEGMENT_LENGTH)
+    return min(max(count, MIN_SEGMENTS), MAX_SEGMENTS)
+
+_templates = {}
+
+def ring_template(segments):
+    '''
+    Unit circle directions of the six vertices of every segment (outer i,
+    outer i+1, inner i, then inner i, outer i+1, inner i+1) and which of them
+    are on the outer edge. Cached per segment count.
+    '''
+    template = _templates.get(segments)
+    if template is None:
+        angles = numpy.linspace(0, 2 * math.pi, segments + 1)
+        index = numpy.array([0, 1, 0, 0, 1, 1])
+        on_outer = numpy.array([True, True, False, False, True, False])
+        step = numpy.arange(segments)[:, None] + index
+        template = (numpy.float32(numpy.cos(angles)[step].ravel()),
+                    numpy.float32(numpy.sin(angles)[step].ravel()),
+                    numpy.tile(on_outer, segments))
+        _templates[segments] = template
+    return template
+
+def annulus_triangles(xs, ys, inner, outer, segments):
+    '''
+    Triangles covering the rings between the inner and outer radii around
+    every center, (len(xs) * segments * 6, 2) float32 vertices. A zero inner
+    radius gives a disc (and degenerate triangles, which draw nothing).
+    Also returns, for every vertex, whether it lies on the outer edge.
+    '''
+    ring_cos, ring_sin, outer_vertex = ring_template(segments)
+    xs = numpy.asarray(xs, numpy.float32)[:, None]
+    ys = numpy.asarray(ys, numpy.float32)[:, None]
+    radius = numpy.where(outer_vertex,
+                         numpy.asarray(outer, numpy.float32)[:, None],
+                         numpy.asarray(inner, numpy.float32)[:, None])
+    vertices = numpy.empty((len(xs), len(ring_cos), 2), numpy.float32)
+    vertices[:, :, 0] = xs + radius * ring_cos
+    vertices[:, :, 1] = ys + radius * ring_sin
+    return (vertices.reshape(-1, 2),
+            numpy.tile(outer_vertex, len(xs)))
+
+def ramp(xs, ys, inner, outer, rgba, fade_outward, segments):
+    '''
+    One ring whose color is rgba on one edge and fully transparent on the
+    other, the anti-aliased edge of a circle.
+    '''
+    vertices, outer_vertex = annulus_triangles(xs, ys, inner, outer,
+                                               segments)
+    colors = numpy.empty((len(vertices), 4), numpy.float32)
+    colors[:] = rgba
+    faded = outer_vertex if fade_outward else ~outer_vertex
+    colors[faded, 3] = 0
+    return vertices, colors
+
+def circle_geometry(xs, ys, radii, color, alpha=1.0, thickness=-1):
+    '''
+    Vertices and RGBA colors for a batch of circles drawn like cv2.circle
+    with lineType CV_AA: filled for a negative thickness, otherwise a ring
+    of that width.
+    '''
+    radii = numpy.asarray(radii, numpy.float32)
+    if len(radii) == 0:
+        return (numpy.zeros((0, 2), numpy.float32),
+                numpy.zeros((0, 4), numpy.float32))
+    blue, green, red = [c / 255.0 for c in color[:3]]
+    rgba = (red, green, blue, alpha)
+    segments = segments_for(float(radii.max()) + 1)
+
+    parts = []
+    if thickness < 0:
+        core_inner = numpy.zeros_like(radii)
+        core_outer = numpy.maximum(radii - 0.5, 0)
+    else:
+        half = max(thickness, 1) / 2.0
+        core_inner = numpy.maximum(radii - half, 0)
+        core_outer = radii + half
+        parts.append(ramp(xs, ys, numpy.maximum(core_inner - 1, 0),
+                          core_inner, rgba, False, segments))
+
+    vertices, outer_vertex = annulus_triangles(xs, ys, core_inner, core_outer,
+                                               segments)
+    colors = numpy.empty((len(vertices), 4), numpy.float32)
+    colors[:] = rgba
+    parts.append((vertices, colors))
+    parts.append(ramp(xs, ys, core_outer, core_outer + 1, rgba, True,
+                      segments))
+
+    return (numpy.concatenate([part[0] for part in parts]),
+            numpy.concatenate([part[1] for part in parts]))
+
+
+class GLCompositor(compositor.OverlayCompositor):
+    '''
+    Records circles for GLRenderer instead of drawing them. Everything else
+    the compositor does (the dirty rectangles of other effects) still works.
+    '''
+    def __init__(self, width, height):
+        compositor.OverlayCompositor.__init__(self, width, height)
+        self.opaque = []
+        self.translucent = []
+        self.layers = []
+        self.frame = None
+        self.hud = []
+
+    def opaque_circle(self, dst, center, radius, color, thickness=-1):
+        self.opaque.append(([center[0]], [center[1]], [radius], color, 1.0,
+                            thickness))
+
+    def opaque_circles(self, dst, xs, ys, radii, color, thickness=-1):
+        self.opaque.append((xs, ys, radii, color, 1.0, thickness))
+
+    def circle(self, center, radius, color, opacity, thickness=-1):
+        if opacity <= 0: return
+        self.translucent.append(([center[0]], [center[1]], [radius], color,
+                                 opacity, thickness))
+
+    def circles(self, xs, ys, radii, color, opacity, thickness=-1):
+        if opacity <= 0: return
+        self.translucent.append((xs, ys, radii, color, opacity, thickness))
+
+    def composite(self, dst):
+        # Turn this frame's circles into GL geometry, a frame the window
+        # skips (see display.py) just drops them
+        compositor.OverlayCompositor.composite(self, dst)
+        self.layers = [self.geometry(self.opaque),
+                       self.geometry(self.translucent)]
+        self.opaque = []
+        self.translucent = []
+
+        # The post overlays draw on this frame next, see GLSpriteCache
+        self.frame = dst
+        self.hud = []
+
+    def geometry(self, records):
+        if not records:
+            return None
+        parts = [circle_geometry(*record) for record in records]
+        return (numpy.ascontiguousarray(numpy.concatenate([p[0] for p
+                                                           in parts])),
+                numpy.ascontiguousarray(numpy.concatenate([p[1] for p
+                                                           in parts])))
+
+
+class GLSpriteCache(sprites.SpriteCache):
+    '''
+    Records the text drawn on the frame the GLCompositor composited last, as
+    (BGRA image, left, top), for GLRenderer to draw over the circles. Text
+    drawn on anything else (the Processed window) is blitted as usual.
+    '''
+    def __init__(self, gl_compositor, max_sprites=256):
+        sprites.SpriteCache.__init__(self, max_sprites)
+        self.compositor = gl_compositor
+
+    def text(self, dst, origin, text, scale=1.0, color=(0, 255, 255),
+             shadow=5):
+        if dst is not self.compositor.frame:
+            sprites.SpriteCache.text(self, dst, origin, text, scale, color,
+                                     shadow)
+            return
+        sprite = self.text_sprite(text, scale, color, shadow)
+        self.compositor.hud.append((sprite.bgra(dst.ndim == 2),
+                                    int(origin[0]) - sprite.anchor_x,
+                                    int(origin[1]) - sprite.anchor_y))
+
+
+class GLRenderer(object):
+    '''
+    Draws the frame and the compositor's circles into an OpenGL HighGUI
+    window. show() takes the place of cv2.imshow for that window.
+    '''
+    def __init__(self, window, width, height, gl_compositor):
+        self.window = window
+        self.width = width
+        self.height = height
+        self.compositor = gl_compositor
+        self.texture = None
+        self.sprite_texture = None
+        self.frame = None
+        self.layers = []
+        self.hud = []
+
+        cv2.resizeWindow(window, width, height)
+        cv2.setOpenGlDrawCallback(window, self.draw)
+
+    def show(self, img):
+        self.frame = numpy.ascontiguousarray(img)
+        self.layers = self.compositor.layers
+        self.hud = self.compositor.hud
+        cv2.updateWindow(self.window)
+
+    def create_texture(self):
+        self.texture = GL.glGenTextures(1)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER,
+                           GL.GL_LINEAR)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER,
+                           GL.GL_LINEAR)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGB, self.width,
+                        self.height, 0, GL.GL_BGR, GL.GL_UNSIGNED_BYTE, None)
+
+    def upload(self):
+        if self.texture is None:
+            self.create_texture()
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+
+        # The skeleton effect turns the frame into a single channel image
+        source = GL.GL_LUMINANCE if self.frame.ndim == 2 else GL.GL_BGR
+        height, width = self.frame.shape[:2]
+        GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, 0, 0, width, height, source,
+                           GL.GL_UNSIGNED_BYTE, self.frame)
+
+    def draw_frame(self):
+        w, h = self.width, self.height
+        quad = numpy.float32([[0, 0], [w, 0], [w, h], [0, h]])
+        texcoords = numpy.float32([[0, 0], [1, 0], [1, 1], [0, 1]])
+
+        GL.glEnable(GL.GL_TEXTURE_2D)
+        GL.glColor4f(1, 1, 1, 1)
+        GL.glEnableClientState(GL.GL_VERTEX_ARRAY)
+        GL.glEnableClientState(GL.GL_TEXTURE_COORD_ARRAY)
+        GL.glVertexPointer(2, GL.GL_FLOAT, 0, quad)
+        GL.glTexCoordPointer(2, GL.GL_FLOAT, 0, texcoords)
+        GL.glDrawArrays(GL.GL_QUADS, 0, 4)
+        GL.glDisableClientState(GL.GL_TEXTURE_COORD_ARRAY)
+        GL.glDisable(GL.GL_TEXTURE_2D)
+
+    def draw_layer(self, layer):
+        if layer is None: return
+        vertices, colors = layer
+        GL.glEnableClientState(GL.GL_COLOR_ARRAY)
+        GL.glVertexPointer(2, GL.GL_FLOAT, 0, vertices)
+        GL.glColorPointer(4, GL.GL_FLOAT, 0, colors)
+        GL.glDrawArrays(GL.GL_TRIANGLES, 0, len(vertices))
+        GL.glDisableClientState(GL.GL_COLOR_ARRAY)
+
+    def draw_hud(self):
+        if not self.hud: return
+        if self.sprite_texture is None:
+            self.sprite_texture = GL.glGenTextures(1)
+            GL.glBindTexture(GL.GL_TEXTURE_2D, self.sprite_texture)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER,
+                               GL.GL_NEAREST)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER,
+                               GL.GL_NEAREST)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.sprite_texture)
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+        texcoords = numpy.float32([[0, 0], [1, 0], [1, 1], [0, 1]])
+
+        # The sprites are premultiplied
+        GL.glBlendFunc(GL.GL_ONE, GL.GL_ONE_MINUS_SRC_ALPHA)
+        GL.glEnable(GL.GL_TEXTURE_2D)
+        GL.glColor4f(1, 1, 1, 1)
+        GL.glEnableClientState(GL.GL_TEXTURE_COORD_ARRAY)
+        GL.glTexCoordPointer(2, GL.GL_FLOAT, 0, texcoords)
+        for image, x, y in self.hud:
+            height, width = image.shape[:2]
+            GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA, width, height, 0,
+                            GL.GL_BGRA, GL.GL_UNSIGNED_BYTE, image)
+            quad = numpy.float32([[x, y], [x + width, y],
+                                  [x + width, y + height], [x, y + height]])
+            GL.glVertexPointer(2, GL.GL_FLOAT, 0, quad)
+            GL.glDrawArrays(GL.GL_QUADS, 0, 4)
+        GL.glDisableClientState(GL.GL_TEXTURE_COORD_ARRAY)
+        GL.glDisable(GL.GL_TEXTURE_2D)
+
+    def draw(self, param=None):
+        if self.frame is None: return
+
+        # Frame coordinates, y down, stretched over the whole window
+        GL.glMatrixMode(GL.GL_PROJECTION)
+        GL.glLoadIdentity()
+        GL.glOrtho(0, self.width, self.height, 0, -1, 1)
+        GL.glMatrixMode(GL.GL_MODELVIEW)
+        GL.glLoadIdentity()
+        GL.glDisable(GL.GL_DEPTH_TEST)
+
+        self.upload()
+        self.draw_frame()
+
+        GL.glEnable(GL.GL_BLEND)
+        GL.glBlendFunc(GL.GL_SRC_ALPHA, GL.GL_ONE_MINUS_SRC_ALPHA)
+        for layer in self.layers:
+            self.draw_layer(layer)
+        self.draw_hud()
+        GL.glDisable(GL.GL_BLEND)
+        GL.glDisableClientState(GL.GL_VERTEX_ARRAY)
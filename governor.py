@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+'''
+Adaptive quality governor for the Bubbler.
+
+Fire, the skeleton or a few mess explosions at once can push the frame time
+past what the camera delivers, and the game starts to feel laggy. The
+QualityGovernor is fed the time every frame took (without the wait for the
+camera) and, when the median over the last window frames is above the
+target, steps one quality knob down. Knobs are stepped down in the order
+given and back up in reverse order once the median falls below headroom
+times the target. After every step the samples start over and nothing moves
+for hold_frames frames, so one change has settled before the next is judged.
+A knob that has to go down again within twice its wait after it came back
+up waits twice as long before the next try (up to 32 times hold_frames), so
+the game does not flicker between two levels. The waits of the restored
+knobs halve again (down to hold_frames) for every stable_frames frames
+without a step down, so a few load spikes spread over a long session do not
+leave every recovery slow.
+
+MainBubbler sets up its knobs in this order:
+
+    motion    halve the motion detection resolution
+    aa        draw bubbles without anti-aliasing (software renderer only)
+    mess      half as many drops per mess explosion
+    skeleton  spread the skeleton over frames, a few ms each
+    window    refresh the Processed window 5 times a second
+
+The level (how many knobs are down) is shown at origin on the Live frame, so
+it can be seen in kiosk mode too.
+'''
+import collections, logging
+import numpy
+
+
+class Knob(object):
+    def __init__(self, name, degrade, restore):
+        self.name = name
+        self.degrade = degrade
+        self.restore = restore
+
+
+class QualityGovernor(object):
+    def __init__(self, target_ms, knobs, sprites, origin, font_scale=1.5,
+                 shadow=6, window=30, headroom=0.75, hold_frames=30,
+                 stable_frames=None):
+        self.log = logging.getLogger()
+        self.target = target_ms / 1000.0
+        self.knobs = knobs
+        self.sprites = sprites
+        self.origin = origin
+        self.font_scale = font_scale
+        self.shadow = shadow
+        self.headroom = headroom
+        self.hold_frames = hold_frames
+        self.stable_frames = stable_frames or hold_frames * 32
+        self.samples = collections.deque(maxlen=window)
+        self.level = 0
+        self.since_change = 0
+        self.up_hold = [hold_frames for knob in knobs]
+        self.last_up = None
+        self.since_down = 0
+        self.enabled = True
+
+    def update(self, seconds):
+        self.samples.append(seconds)
+        self.since_change += 1
+        self.since_down += 1
+        if self.since_down >= self.stable_frames:
+            self.since_down = 0
+            for idx in range(self.level, len(self.knobs)):
+                self.up_hold[idx] = max(self.up_hold[idx] // 2,
+                                        self.hold_frames)
+        if (self.since_change < self.hold_frames or
+                len(self.samples) < self.samples.maxlen):
+            return
+
+        median = numpy.median(self.samples)
+        if median > self.target and self.level < len(self.knobs):
+            # Back down soon after it came up: the knob is flapping
+            if (self.last_up == self.level and
+                    self.since_change < 2 * self.up_hold[self.level]):
+                self.up_hold[self.level] = min(self.up_hold[self.level] * 2,
+                                               self.hold_frames * 32)
+            knob = self.knobs[self.level]
+            knob.degrade()
+            self.level += 1
+            self.last_up = None
+            self.since_down = 0
+            self.changed("down", knob, median)
+        elif (median < self.target * self.headroom and self.level > 0 and
+              self.since_change >= self.up_hold[self.level - 1]):
+            self.level -= 1
+            knob = self.knobs[self.level]
+            knob.restore()
+            self.last_up = self.level
+            self.changed("up", knob, median)
+
+    def changed(self, direction, knob, median):
+        self.log.info("Quality " + direction + ": " + knob.name +
+                      ", median frame %0.1f ms, target %0.1f ms" %
+                      (median * 1000, self.target * 1000))
+        self.samples.clear()
+        self.since_change = 0
+
+    def text(self):
+        if self.level == 0:
+            return 'Quality: full'
+        return 'Quality: -%d %s' % (self.level, self.knobs[self.level - 1].name)
+
+    def post_process(self, in_mat, in_motion_mat):
+        self.sprites.text(in_mat, self.origin, self.text(), self.font_scale,
+                          (255, 255, 255), self.shadow)
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+'''
+Motion detection back-ends for the Bubbler.
+
+Every engine turns a color camera frame into the binary motion mask that the
+effects and collisions work on, and is told about each new reference image
+(the startup countdown and the 'r' key). Pick one with create(name):
+
+    static   - difference against the fixed reference image, the original
+               find_motion
+    average  - difference against a running average of the scene, updated in
+               place with cv2.accumulateWeighted, so slow lighting drift and
+               shadows fade into the background
+    mog2     - OpenCV's MOG2 background subtractor, shadows are discarded
+    knn      - OpenCV's KNN background subtractor (OpenCV 3 and later)
+    tiled    - the static difference, computed only around the tiles of the
+               frame that changed
+
+All of them finish with the same box blur and threshold so the mask has the
+same blobby shape whichever engine made it. Intermediate images are kept
+between frames and written with dst= outputs; the returned mask is a new array
+every frame because effects draw on it.
+
+With scale set to 2 or 4 the engine works on a frame shrunk by that factor and
+returns a mask of that reduced size, with the blur kernel shrunk to match. The
+20x20 blur throws most of the full resolution detail away anyway, so only the
+shrink itself still touches every pixel. Use expand() when an effect needs the
+mask at the full frame size.
+
+MaskChangeDetector tells the expensive mask derived effects (skeleton, fire
+contours) when the mask has moved on enough to be worth recomputing.
+'''
+import cv2
+import numpy
+
+
+class MotionDetector(object):
+    '''
+    The shared shrink, blur and threshold steps. On its own it detects motion
+    as the difference against the reference image; the other engines replace
+    learn_reference() and detect().
+    '''
+    name = None
+
+    def __init__(self, kernel_size=20, threshold=20, scale=1):
+        self.kernel_size = kernel_size
+        self.threshold = threshold
+        self.scale = scale
+        self.small = []
+        self.gray = None
+        self.diff = None
+        self.blurred = None
+        self.reference_gray = None
+
+    def allocate(self, frame):
+        height, width = frame.shape[:2]
+        if self.gray is None or self.gray.shape != (height, width):
+            self.gray = numpy.empty((height, width), numpy.uint8)
+            self.diff = numpy.empty((height, width), numpy.uint8)
+            self.blurred = numpy.empty((height, width), numpy.uint8)
+
+    def shrink(self, frame):
+        # Halve the frame until it reaches the scale. Each 2x INTER_AREA step
+        # is a cheap 2x2 average, while one direct 4x step is much slower.
+        level = 0
+        scale = self.scale
+        while scale > 1:
+            height, width = frame.shape[:2]
+            size = (width // 2, height // 2)
+            if len(self.small) <= level:
+                self.small.append(None)
+            buf = self.small[level]
+            if buf is None or buf.shape[:2] != (size[1], size[0]):
+                buf = numpy.empty((size[1], size[0]) + frame.shape[2:],
+                                  frame.dtype)
+                self.small[level] = buf
+            cv2.resize(frame, size, buf, interpolation=cv2.INTER_AREA)
+            frame = buf
+            scale //= 2
+            level += 1
+        return frame
+
+    def to_gray(self, frame):
+        self.allocate(frame)
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, self.gray)
+        return self.gray
+
+    def blur_threshold(self, diff):
+        kernel_size = max(self.kernel_size // self.scale, 1)
+        cv2.blur(diff, (kernel_size, kernel_size), self.blurred)
+        ret, mask = cv2.threshold(self.blurred, self.threshold, 255,
+                                  cv2.THRESH_BINARY)
+        return mask
+
+    def reset(self, reference_frame):
+        self.learn_reference(self.shrink(reference_frame))
+
+    def motion_bounds(self):
+        '''
+        (x0, y0, x1, y1) of the part of the last mask that can hold motion,
+        in mask coordinates. Everything outside it is zero.
+        '''
+        if self.gray is None:
+            return None
+        height, width = self.gray.shape
+        return (0, 0, width, height)
+
+    def apply(self, frame):
+        return self.detect(self.shrink(frame))
+
+    def learn_reference(self, reference_frame):
+        self.reference_gray = cv2.cvtColor(reference_frame,
+                                           cv2.COLOR_BGR2GRAY)
+
+    def detect(self, frame):
+        gray = self.to_gray(frame)
+        cv2.absdiff(self.reference_gray, gray, self.diff)
+        return self.blur_threshold(self.diff)
+
+
+class StaticDiff(MotionDetector):
+    ''' The plain reference difference of MotionDetector. '''
+    name = 'static'
+
+
+class Tiled(StaticDiff):
+    '''
+    The static difference, restricted to the tiles that changed.
+
+    The camera frame is split into a grid of tile_size pixels. Every
+    decimate'th pixel of the full size frame is compared with the reference,
+    and a tile where any sample moved by more than the threshold is active.
+    When nothing is active the frame is not even shrunk. Otherwise runs of
+    active tiles are differenced, blurred and thresholded with a border of one
+    blur kernel, which is enough for the result inside the active area to
+    match the full frame computation exactly. Everything else in the mask is
+    zero. Motion thinner than the decimation step can be missed.
+
+    After each frame active_tiles holds the boolean tile grid, active_rects the
+    regions of the mask that were computed and motion_bounds() their union,
+    so collisions and effects can skip the dead parts of the frame. When most
+    tiles are active the whole frame is processed in one go.
+    '''
+    name = 'tiled'
+
+    def __init__(self, tile_size=64, decimate=4, full_fraction=0.5, **kw):
+        StaticDiff.__init__(self, **kw)
+        self.decimate = decimate
+        self.full_fraction = full_fraction
+
+        # Whole tiles have to survive both the decimation and the shrink
+        self.tile_size = max(tile_size - tile_size % max(decimate, self.scale),
+                             max(decimate, self.scale))
+        self.reference_samples = None
+        self.decimated = None
+        self.padded = None
+        self.active_tiles = None
+        self.active_rects = []
+        self.bounds = None
+
+    def sample(self, frame, dst=None):
+        # Nearest neighbour resizing by a whole factor picks every step'th
+        # pixel, far cheaper than copying a strided view
+        height, width = frame.shape[:2]
+        size = (-(-width // self.decimate), -(-height // self.decimate))
+        if self.decimated is None or self.decimated.shape[:2] != size[::-1]:
+            self.decimated = numpy.empty(size[::-1] + frame.shape[2:],
+                                         frame.dtype)
+        cv2.resize(frame, size, self.decimated,
+                   interpolation=cv2.INTER_NEAREST)
+        return cv2.cvtColor(self.decimated, cv2.COLOR_BGR2GRAY, dst)
+
+    def reset(self, reference_frame):
+        StaticDiff.reset(self, reference_frame)
+        self.reference_samples = self.sample(reference_frame)
+
+    def find_tiles(self, frame):
+        height, width = frame.shape[:2]
+        per_tile = self.tile_size // self.decimate
+        tiles_y = -(-height // self.tile_size)
+        tiles_x = -(-width // self.tile_size)
+
+        # The samples sit in the corner of a buffer padded out to whole tiles
+        shape = (tiles_y * per_tile, tiles_x * per_tile)
+        if self.padded is None or self.padded.shape != shape:
+            self.padded = numpy.zeros(shape, numpy.uint8)
+        rows, cols = self.reference_samples.shape
+        samples = self.padded[:rows, :cols]
+        self.sample(frame, samples)
+        cv2.absdiff(samples, self.reference_samples, samples)
+
+        largest = self.padded.reshape(tiles_y, per_tile, tiles_x, per_tile)
+        largest = largest.max(axis=3).max(axis=1)
+        return largest > self.threshold
+
+    def tile_rects(self, active, tile):
+        '''
+        Merge the active tiles into rectangles: runs along each tile row,
+        joined with the identical run on the row above.
+        '''
+        rects = []
+        open_runs = {}
+        for ty in range(active.shape[0]):
+            columns = numpy.flatnonzero(active[ty])
+            runs = {}
+            if len(columns):
+                breaks = numpy.flatnonzero(numpy.diff(columns) > 1)
+                starts = [columns[0]] + list(columns[breaks + 1])
+                ends = list(columns[breaks]) + [columns[-1]]
+                for start, end in zip(starts, ends):
+                    run = (start, end + 1)
+                    runs[run] = open_runs.pop(run, ty)
+            for (start, end), top in open_runs.items():
+                rects.append((start * tile, top * tile, end * tile, ty * tile))
+            open_runs = runs
+        for (start, end), top in open_runs.items():
+            rects.append((start * tile, top * tile, end * tile,
+                          active.shape[0] * tile))
+        return rects
+
+    def apply(self, frame):
+        self.active_tiles = self.find_tiles(frame)
+        if not self.active_tiles.any():
+            self.active_rects = []
+            self.bounds = (0, 0, 0, 0)
+            return numpy.zeros(self.reference_gray.shape, numpy.uint8)
+        return self.detect(self.shrink(frame))
+
+    def detect(self, frame):
+        self.allocate(frame)
+        height, width = frame.shape[:2]
+        if self.active_tiles.mean() > self.full_fraction:
+            self.active_rects = [(0, 0, width, height)]
+            self.bounds = (0, 0, width, height)
+            return StaticDiff.detect(self, frame)
+
+        kernel_size = max(self.kernel_size // self.scale, 1)
+        border = kernel_size // 2 + 1
+        mask = numpy.zeros((height, width), numpy.uint8)
+        self.active_rects = []
+        tile = self.tile_size // self.scale
+        for x0, y0, x1, y1 in self.tile_rects(self.active_tiles, tile):
+            # The output grows by the reach of the blur, the input by twice it
+            ox0, oy0 = max(x0 - border, 0), max(y0 - border, 0)
+            ox1, oy1 = min(x1 + border, width), min(y1 + border, height)
+            ix0, iy0 = max(ox0 - border, 0), max(oy0 - border, 0)
+            ix1, iy1 = min(ox1 + border, width), min(oy1 + border, height)
+
+            gray = self.gray[iy0:iy1, ix0:ix1]
+            diff = self.diff[iy0:iy1, ix0:ix1]
+            blurred = self.blurred[iy0:iy1, ix0:ix1]
+            cv2.cvtColor(frame[iy0:iy1, ix0:ix1], cv2.COLOR_BGR2GRAY, gray)
+            cv2.absdiff(self.reference_gray[iy0:iy1, ix0:ix1], gray, diff)
+            cv2.blur(diff, (kernel_size, kernel_size), blurred)
+            cv2.threshold(blurred[oy0 - iy0:oy1 - iy0, ox0 - ix0:ox1 - ix0],
+                          self.threshold, 255, cv2.THRESH_BINARY,
+                          mask[oy0:oy1, ox0:ox1])
+            self.active_rects.append((ox0, oy0, ox1, oy1))
+
+        x0s, y0s, x1s, y1s = zip(*self.active_rects)
+        self.bounds = (min(x0s), min(y0s), max(x1s), max(y1s))
+        return mask
+
+    def motion_bounds(self):
+        return self.bounds
+
+
+class RunningAverage(MotionDetector):
+    name = 'average'
+
+    def __init__(self, learning_rate=0.02, **kw):
+        MotionDetector.__init__(self, **kw)
+        self.learning_rate = learning_rate
+        self.background = None
+        self.background_gray = None
+
+    def learn_reference(self, reference_frame):
+        gray = cv2.cvtColor(reference_frame, cv2.COLOR_BGR2GRAY)
+        self.background = numpy.float32(gray)
+        self.background_gray = gray
+
+    def detect(self, frame):
+        gray = self.to_gray(frame)
+        cv2.absdiff(self.background_gray, gray, self.diff)
+        mask = self.blur_threshold(self.diff)
+
+        # Only learn from the parts of the scene nobody is standing in, so a
+        # player holding still doesn't melt into the background
+        learn = cv2.bitwise_not(mask, self.blurred)
+        cv2.accumulateWeighted(gray, self.background, self.learning_rate,
+                               learn)
+        cv2.convertScaleAbs(self.background, self.background_gray)
+        return mask
+
+
+class Subtractor(MotionDetector):
+    '''
+    Common code for the OpenCV background subtractor engines, MOG2 unless a
+    subclass creates another subtractor.
+    '''
+    shadow_value = 127
+
+    def __init__(self, **kw):
+        MotionDetector.__init__(self, **kw)
+        self.subtractor = self.create_subtractor()
+
+    def create_subtractor(self):
+        if hasattr(cv2, 'createBackgroundSubtractorMOG2'):
+            return cv2.createBackgroundSubtractorMOG2(detectShadows=True)
+        return cv2.BackgroundSubtractorMOG2()
+
+    def learn_reference(self, reference_frame):
+        # Start a fresh model that has only seen the empty room
+        self.subtractor = self.create_subtractor()
+        self.subtractor.apply(reference_frame, learningRate=1.0)
+
+    def detect(self, frame):
+        self.allocate(frame)
+        foreground = self.subtractor.apply(frame)
+
+        # Shadows are marked as gray, keep only the definite foreground
+        cv2.threshold(foreground, self.shadow_value, 255, cv2.THRESH_BINARY,
+                      self.diff)
+        return self.blur_threshold(self.diff)
+
+
+class MOG2(Subtractor):
+    name = 'mog2'
+
+
+class KNN(Subtractor):
+    name = 'knn'
+
+    def create_subtractor(self):
+        if not hasattr(cv2, 'createBackgroundSubtractorKNN'):
+            raise RuntimeError("The KNN background subtractor needs OpenCV 3")
+        return cv2.createBackgroundSubtractorKNN(detectShadows=True)
+
+
+class MaskChangeDetector(object):
+    '''
+    Compares each motion mask with the mask the effect last recomputed from,
+    by counting the pixels that differ (XOR). changed() is True when more than
+    min_fraction of the mask differs, when the mask changed size, or when
+    refresh_interval frames have gone by since the last recompute. Comparing
+    against the last used mask rather than the previous frame keeps a slow
+    drift from going unnoticed.
+    '''
+    def __init__(self, min_fraction=0.01, refresh_interval=30):
+        self.min_fraction = min_fraction
+        self.refresh_interval = refresh_interval
+        self.previous = None
+        self.diff = None
+        self.age = 0
+        self.last_fraction = 1.0
+
+    def force(self):
+        ''' Recompute on the next frame whatever the mask does. '''
+        self.previous = None
+
+    def changed(self, mask):
+        self.age += 1
+        if self.previous is None or self.previous.shape != mask.shape:
+            self.previous = mask.copy()
+            self.diff = numpy.empty_like(mask)
+            self.age = 0
+            self.last_fraction = 1.0
+            return True
+
+        cv2.bitwise_xor(mask, self.previous, self.diff)
+        self.last_fraction = (cv2.countNonZero(self.diff) /
+                              float(self.diff.size))
+        if (self.last_fraction > self.min_fraction or
+                self.age >= self.refresh_interval):
+            numpy.copyto(self.previous, mask)
+            self.age = 0
+            return True
+        return False
+
+
+def expand(mask, width, height):
+    ''' Bring a reduced resolution mask back up to the frame size. '''
+    if mask.shape[1] == width and mask.shape[0] == height:
+        return mask
+    return cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+
+
+engines = dict((Class.name, Class) for Class in
+               (StaticDiff, RunningAverage, MOG2, KNN, Tiled))
+
+def create(name, **kw):
+    return engines[name](**kw)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+'''
+Process pool offload for heavy pre process effects.
+
+An effect that sets heavy = True can have its expensive kernel run in a worker
+process instead of inside the frame. OffloadPool copies the motion mask into a
+shared memory slot (multiprocessing.sharedctypes.RawArray, mapped as NumPy
+arrays on both sides), so no image is ever pickled. The kernel writes its
+image result into the slot's output buffer and may return a small Python
+result, such as contour lists. The frame never waits: until a job finishes
+the effect keeps applying the last completed result, which may be a frame or
+two stale.
+
+A heavy effect provides:
+
+    offload_wanted(in_motion_mat) - True when a new job is worth starting,
+                                    only asked while no job is in flight
+    offload_job()                 - (kernel name, picklable parameters)
+    offload_collect(output, result) - copy a finished job's output buffer
+                                      and result into the effect
+    offload_apply(in_mat, in_motion_mat) - what pre_process returns this frame
+
+The kernels are plain functions in this module, registered in KERNELS, so the
+worker processes never import the Qt application. Each effect gets its own
+slot; a slot that no effect has used for a few frames goes back to the pool.
+When every slot is taken the effect simply runs inline.
+'''
+import logging, multiprocessing, traceback
+from multiprocessing import sharedctypes
+import cv2
+import numpy
+
+import skeleton
+
+# Worker side state, set up once per process by init_worker
+_buffers = []
+_engines = {}
+
+
+def shared_image(raw, shape):
+    return numpy.frombuffer(raw, numpy.uint8).reshape(shape)
+
+def init_worker(raws, shape):
+    global _buffers
+    _buffers = [(shared_image(source, shape), shared_image(output, shape))
+                for source, output in raws]
+
+def run_kernel(kernel, slot, params):
+    source, output = _buffers[slot]
+    return KERNELS[kernel](source, output, params)
+
+
+def skeleton_kernel(mask, output, params):
+    method, max_passes = params
+    engine = _engines.get(method)
+    if engine is None:
+        engine = skeleton.SkeletonEngine(method=method)
+        _engines[method] = engine
+    engine.max_passes = max_passes
+    numpy.copyto(output, engine.skeletonize(mask))
+
+def contour_kernel(mask, output, params):
+    conts, hier = cv2.findContours(mask, cv2.RETR_TREE,
+                                   cv2.CHAIN_APPROX_SIMPLE)
+    contours = [cv2.approxPolyDP(cnt, params, True) for cnt in conts]
+    return contours, hier
+
+KERNELS = {
+    'skeleton' : skeleton_kernel,
+    'contours' : contour_kernel,
+}
+
+
+class Slot(object):
+    def __init__(self, index, source, output):
+        self.index = index
+        self.source = source
+        self.output = output
+        self.owner = None
+        self.job = None
+        self.last_used = 0
+
+
+class OffloadPool(object):
+    def __init__(self, width, height, processes=1, slots=4, idle_frames=3):
+        self.log = logging.getLogger()
+        self.shape = (height, width)
+        self.idle_frames = idle_frames
+        self.frame = 0
+
+        raws = [(sharedctypes.RawArray('B', width * height),
+                 sharedctypes.RawArray('B', width * height))
+                for idx in range(slots)]
+        self.slots = [Slot(idx, shared_image(source, self.shape),
+                           shared_image(output, self.shape))
+                      for idx, (source, output) in enumerate(raws)]
+        self.pool = multiprocessing.Pool(processes, init_worker,
+                                         (raws, self.shape))
+
+    def begin_frame(self):
+        self.frame += 1
+
+    def slot_for(self, effect):
+        free = None
+        for slot in self.slots:
+            if slot.owner is effect:
+                return slot
+            idle = (slot.owner is None or
+                    self.frame - slot.last_used > self.idle_frames)
+            if not idle:
+                continue
+            # Nobody collects the job of an effect that went away, drop it
+            # once it is done instead of losing the slot for good
+            if slot.job is not None:
+                if not slot.job.ready():
+                    continue
+                slot.job = None
+            free = slot
+
+        if free is not None:
+            free.owner = effect
+        return free
+
+    def pre_process(self, effect, in_mat, in_motion_mat):
+        slot = self.slot_for(effect)
+        if slot is None or in_motion_mat.shape != self.shape:
+            return effect.pre_process(in_mat, in_motion_mat)
+        slot.last_used = self.frame
+
+        if slot.job is not None and slot.job.ready():
+            job, slot.job = slot.job, None
+            try:
+                effect.offload_collect(slot.output, job.get())
+            except Exception:
+                self.log.critical("OFFLOAD " + effect.__class__.__name__ +
+                                  ": " + traceback.format_exc())
+
+        if slot.job is None and effect.offload_wanted(in_motion_mat):
+            numpy.copyto(slot.source, in_motion_mat)
+            kernel, params = effect.offload_job()
+            slot.job = self.pool.apply_async(run_kernel,
+                                             (kernel, slot.index, params))
+
+        return effect.offload_apply(in_mat, in_motion_mat)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+'''
+Structure of arrays storage for large groups of identical bubbles.
+
+A Bubble is a full Python object with its own QObject signal instance, which is
+a lot of weight for the 50 green drops of a mess explosion or a screen full of
+good bubbles. ParticleStore keeps every bubble of a group in NumPy arrays
+(x, y, radius, opacity and vertical increment) and moves, fades and resets the
+whole group with a handful of array operations. The methods mirror the Bubble
+ones and take an optional boolean array selecting which particles to update.
+Use record() to look at a single particle.
+'''
+import collections
+import numpy
+
+Particle = collections.namedtuple('Particle',
+                                  'x y radius opacity increment')
+
+
+class ParticleStore(object):
+    def __init__(self, count, max_x, max_y, radius=20, increment=8,
+                 opacity_increment=0.01):
+        self.max_x = max_x
+        self.max_y = max_y
+        self.opacity_increment = opacity_increment
+
+        self.x = numpy.zeros(count, numpy.int32)
+        self.y = numpy.zeros(count, numpy.int32)
+        self.radius = numpy.empty(count, numpy.int32)
+        self.radius.fill(radius)
+        self.increment = numpy.empty(count, numpy.int32)
+        self.increment.fill(increment)
+        self.opacity = numpy.ones(count, numpy.float32)
+
+        self.reset_position()
+
+    def __len__(self):
+        return len(self.x)
+
+    def select(self, which):
+        if which is None:
+            return numpy.ones(len(self), numpy.bool_)
+        return which
+
+    def place(self, xs, ys):
+        self.x[:] = xs
+        self.y[:] = ys
+
+    def reset_position(self, which=None):
+        # Start somewhere above the top of the screen so the bubbles drift in
+        which = self.select(which)
+        count = numpy.count_nonzero(which)
+        if count == 0: return
+        self.y[which] = -10 - numpy.random.randint(100, self.max_y, count)
+        self.x[which] = numpy.random.randint(0, self.max_x, count)
+
+    def animate(self, which=None):
+        which = self.select(which)
+        self.y[which] += self.increment[which]
+
+        # Add the radius distance to make sure huge bubbles animate all the
+        # way off screen
+        self.reset_position(which & (self.y > self.max_y + self.radius))
+
+    def auto_fade(self, which=None):
+        # Gradually fade out, and move fully transparent bubbles off the
+        # screen so they are considered done
+        which = self.select(which)
+        self.opacity[which] -= self.opacity_increment
+        self.y[which & (self.opacity < 0)] = -10
+
+    def visible(self):
+        return self.y >= 0
+
+    def record(self, index):
+        return Particle(int(self.x[index]), int(self.y[index]),
+                        int(self.radius[index]), float(self.opacity[index]),
+                        int(self.increment[index]))
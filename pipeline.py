@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+'''
+Pipelined motion detection for the Bubbler.
+
+Normally the frame loop reads the camera, finds the motion and runs the effect
+stages one after the other on the Qt main thread. MotionPipeline moves the
+camera read, the flip and the motion detection onto a worker thread, so the
+motion mask for the next frame is computed while the main thread runs the
+game and draws the current one. OpenCV releases the GIL inside its calls, so
+the two really do run on separate cores.
+
+Finished frames are handed over in a bounded queue of slots. depth is how many
+finished frames the worker may have waiting: 1 keeps the display one frame
+behind the camera in exchange for the overlap, more smooths out uneven effect
+costs at the price of another frame of latency per step. The worker waits
+when the queue is full, so no frame is ever dropped between the two threads.
+
+The worker owns the motion engine while the pipeline runs. A new reference
+image (the 'r' key) is passed in through reset(), which the worker applies
+before its next frame; frames already in flight were measured against the old
+reference and are thrown away.
+
+Only capture and motion detection move to the worker. The game and post
+stages and the display stay serial on the main thread, on purpose: the
+effects emit Qt signals while they run, and HighGUI has to
+be driven from the GUI thread, so neither stage can leave it without moving
+the game off Qt. It would not gain much either: with every effect on, the
+game stage takes 3.3 ms (p50), the compositor 0.4 ms and the post overlays
+under 0.1 ms of a 12 ms frame, and about half of the game time is Python
+holding the GIL, the rest hundreds of tiny cv2.circle calls. The pre effects that do cost time can go to worker processes with
+--offload, see offload.py.
+
+Both threads block on the condition without a timeout: in Python 2 a timed
+wait polls with sleeps of up to 50 ms, which costs more than the overlap
+gains. The worker wakes the main thread after a failed camera read instead.
+'''
+import collections, logging, threading
+
+from common import clock
+
+
+class Slot(object):
+    __slots__ = ('frame', 'mask', 'bounds', 'seconds', 'stamp')
+
+    def __init__(self, frame, mask, bounds, seconds, stamp=None):
+        self.frame = frame
+        self.mask = mask
+        self.bounds = bounds
+        self.seconds = seconds
+        self.stamp = stamp
+
+
+class MotionPipeline(object):
+    def __init__(self, cam, prepare, engine, depth=1):
+        self.log = logging.getLogger()
+        self.cam = cam
+        self.prepare = prepare
+        self.engine = engine
+        self.depth = max(depth, 1)
+
+        self.ready = collections.deque()
+        self.generation = 0
+        self.pending_reference = None
+        self.failures = 0
+
+        self.cond = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="MotionPipeline")
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def scale(self):
+        return self.engine.scale
+
+    def reset(self, reference_frame):
+        ''' Take a new reference, safe to call from the main thread. '''
+        with self.cond:
+            self.pending_reference = reference_frame.copy()
+            self.generation += 1
+            self.ready.clear()
+            self.cond.notify_all()
+
+    def run(self):
+        while self.running:
+            with self.cond:
+                while self.running and len(self.ready) >= self.depth:
+                    self.cond.wait()
+                if not self.running:
+                    break
+                reference = self.pending_reference
+                self.pending_reference = None
+                generation = self.generation
+
+            if reference is not None:
+                self.engine.reset(reference)
+
+            ret, img = self.cam.read()
+            if not ret or img is None:
+                with self.cond:
+                    self.failures += 1
+                    self.cond.notify_all()
+                if self.failures % 100 == 1:
+                    self.log.warn("Pipeline read failure " +
+                                  str(self.failures))
+                continue
+            # Recorded and replayed frames carry their time stamp
+            stamp = getattr(self.cam, 'stamp', None)
+
+            start = clock()
+            frame = self.prepare(img)
+            mask = self.engine.apply(frame)
+            bounds = self.engine.motion_bounds()
+            slot = Slot(frame, mask, bounds, clock() - start, stamp)
+
+            with self.cond:
+                if generation == self.generation:
+                    self.ready.append(slot)
+                    self.cond.notify_all()
+
+    def read(self):
+        '''
+        Return the next finished Slot, or None when the camera read failed
+        before one was ready. The slot's frame and mask belong to the caller
+        from then on.
+        '''
+        with self.cond:
+            failures = self.failures
+            while not self.ready:
+                if failures != self.failures or not self.running:
+                    return None
+                self.cond.wait()
+            slot = self.ready.popleft()
+            self.cond.notify_all()
+        return slot
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join(1.0)
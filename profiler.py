@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+'''
+Frame time instrumentation for the Bubbler.
+
+FrameProfiler times the named sections of every frame (capture, find_motion,
+timers, each pre/game/post effect, display) and keeps a rolling window of
+samples for each one. The post_process HUD shows p50/p95/p99 milliseconds per
+section on the "Processed" window so operators can see which effect is eating
+the frame on the venue hardware. Sections that run more than once in a frame
+(several UpBubble instances, say) are summed for that frame.
+
+Every frame can optionally be streamed to a log file: a .csv path gets one
+"frame,section,ms" row per section, anything else gets one JSON object per
+line.
+'''
+import collections, contextlib, csv, json
+import numpy
+
+from common import clock, small_draw_str
+
+
+class FrameProfiler(object):
+    def __init__(self, window=300, log_path=None, hud_interval=15):
+        self.window = window
+        self.samples = {}
+        self.names = []
+        self.current = collections.OrderedDict()
+        self.frame = 0
+        self.frame_start = None
+        self.last_frame_time = 0.0
+
+        # The percentiles are only recomputed for the HUD every few frames
+        self.enabled = False
+        self.hud_interval = hud_interval
+        self.hud_lines = []
+        self.draws_on_mask = True   # The HUD goes on the Processed window
+
+        self.log_file = None
+        self.csv_writer = None
+        if log_path is not None:
+            self.open_log(log_path)
+
+    def open_log(self, log_path):
+        self.log_file = open(log_path, 'wb')
+        if log_path.lower().endswith('.csv'):
+            self.csv_writer = csv.writer(self.log_file)
+            self.csv_writer.writerow(['frame', 'section', 'ms'])
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+    def reset(self):
+        ''' Forget every sample, used to drop warm up frames. '''
+        self.samples = {}
+        self.names = []
+        self.hud_lines = []
+
+    def begin_frame(self):
+        self.current.clear()
+        self.frame_start = clock()
+
+    def add(self, name, seconds):
+        self.current[name] = self.current.get(name, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def section(self, name):
+        start = clock()
+        try:
+            yield
+        finally:
+            self.add(name, clock() - start)
+
+    def end_frame(self):
+        if self.frame_start is None: return
+        self.last_frame_time = clock() - self.frame_start
+        self.add('frame', self.last_frame_time)
+
+        for name, seconds in self.current.items():
+            samples = self.samples.get(name)
+            if samples is None:
+                samples = collections.deque(maxlen=self.window)
+                self.samples[name] = samples
+                self.names.append(name)
+            samples.append(seconds)
+
+        self.write_log()
+        self.frame += 1
+        if self.enabled and self.frame % self.hud_interval == 0:
+            self.hud_lines = self.hud_text()
+
+    def write_log(self):
+        if self.log_file is None: return
+        if self.csv_writer is not None:
+            for name, seconds in self.current.items():
+                self.csv_writer.writerow([self.frame, name,
+                                          '%0.3f' % (seconds * 1000)])
+        else:
+            timings = dict((name, round(seconds * 1000, 3))
+                           for name, seconds in self.current.items())
+            self.log_file.write(json.dumps({'frame' : self.frame,
+                                            'ms' : timings}) + '\n')
+
+    def percentiles(self, name, points=(50, 95, 99)):
+        ''' Rolling percentiles of the section in milliseconds. '''
+        samples = self.samples.get(name)
+        if not samples:
+            return [0.0 for point in points]
+        return [value * 1000 for value in
+                numpy.percentile(numpy.array(samples), points)]
+
+    def summary(self):
+        return [(name,) + tuple(self.percentiles(name)) for name in self.names]
+
+    def hud_text(self):
+        lines = ['%-22s %6s %6s %6s' % ('ms', 'p50', 'p95', 'p99')]
+        for name, p50, p95, p99 in self.summary():
+            lines.append('%-22s %6.1f %6.1f %6.1f' %
+                         (name[:22], p50, p95, p99))
+        return lines
+
+    def post_process(self, in_mat, in_motion_mat):
+        # None when the Processed window skips this frame
+        if in_motion_mat is None: return
+        if not self.hud_lines:
+            self.hud_lines = self.hud_text()
+        y = 80
+        for line in self.hud_lines:
+            small_draw_str(in_motion_mat, (10, y), line)
+            y += 12
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+'''
+Named performance profiles for the Bubbler.
+
+A profile sets everything that has to change together when the game moves
+to weaker or stronger hardware: the size the camera is asked for, the size
+frames are processed at, the camera frame rate, the motion blur kernel and
+motion scale, bubble sizes and speeds, how many bubbles the game throws
+around, and the budgets of the expensive effects. Select one with
+--profile NAME; options given on the command line still win over the
+profile.
+
+    classic   800x600, the original settings (the default), leaves the
+              camera frame rate alone
+    netbook   320x240 at 30 fps for weak laptops
+    standard  640x480 at 30 fps
+    showcase  1280x720 at 60 fps for big screens on a fast machine
+
+Bubble speeds are a fraction of the frame height per frame, so a bubble
+takes the same time to fall at every resolution, and half the fraction at
+60 fps keeps that time at twice the frame rate. Every other size in pixels
+(HUD offsets, the mess drops, how far effects move) was picked for the
+classic 600 pixel high frame and is multiplied by PIXEL_SCALE, the frame
+height over 600.
+'''
+
+# The frame height the game's pixel sizes were picked for
+BASE_HEIGHT = 600.0
+
+
+class Profile(object):
+    def __init__(self, name, width, height, fps, capture_size=None,
+                 blur_kernel=20, motion_scale=1, bubble_speed=1/75.0,
+                 good_radius=20, bad_radius=10, bad_radius_jump=10,
+                 max_bubbles=10, max_mess_bubbles=50, skeleton_budget_ms=None,
+                 processed_fps=None):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.capture_size = capture_size or (width, height)
+        self.blur_kernel = blur_kernel
+        self.motion_scale = motion_scale
+        self.bubble_speed = bubble_speed
+        self.good_radius = good_radius
+        self.bad_radius = bad_radius
+        self.bad_radius_jump = bad_radius_jump
+        self.max_bubbles = max_bubbles
+        self.max_mess_bubbles = max_mess_bubbles
+        self.skeleton_budget_ms = skeleton_budget_ms
+        self.processed_fps = processed_fps
+
+    def settings(self):
+        ''' The Bubbler module globals this profile sets. '''
+        return dict(IMG_WIDTH=self.width,
+                    IMG_HEIGHT=self.height,
+                    PIXEL_SCALE=self.height / BASE_HEIGHT,
+                    CAPTURE_SIZE=self.capture_size,
+                    CAMERA_FPS=self.fps,
+                    BLUR_KERNEL=self.blur_kernel,
+                    MOTION_SCALE=self.motion_scale,
+                    BUBBLE_SPEED=self.bubble_speed,
+                    GOOD_RADIUS=self.good_radius,
+                    BAD_RADIUS=self.bad_radius,
+                    BAD_RADIUS_JUMP=self.bad_radius_jump,
+                    MAX_BUBBLES=self.max_bubbles,
+                    MAX_MESS_BUBBLES=self.max_mess_bubbles,
+                    SKELETON_BUDGET_MS=self.skeleton_budget_ms,
+                    PROCESSED_FPS=self.processed_fps)
+
+
+PROFILES = dict((profile.name, profile) for profile in [
+    Profile('classic', 800, 600, None),
+    Profile('netbook', 320, 240, 30, blur_kernel=8, good_radius=8,
+            bad_radius=4, bad_radius_jump=4, max_bubbles=6,
+            max_mess_bubbles=20, skeleton_budget_ms=4, processed_fps=5),
+    Profile('standard', 640, 480, 30, blur_kernel=16, good_radius=16,
+            bad_radius=8, bad_radius_jump=8, max_mess_bubbles=40,
+            skeleton_budget_ms=8, processed_fps=10),
+    Profile('showcase', 1280, 720, 60, blur_kernel=24, motion_scale=2,
+            bubble_speed=1/150.0, good_radius=24, bad_radius=12,
+            bad_radius_jump=12, max_bubbles=14, max_mess_bubbles=60,
+            processed_fps=15),
+])
+
+DEFAULT = 'classic'
+
+
+def apply(name, namespace):
+    ''' Set the profile's values in namespace, e.g. vars(Bubbler). '''
+    namespace.update(PROFILES[name].settings())
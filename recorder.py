@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+'''
+Background gameplay recorder for the Bubbler.
+
+Encoding a frame with cv2.VideoWriter takes longer than many of the effects,
+so the frame loop only copies the finished frame into one of a fixed number of
+preallocated buffers and queues it. A writer thread encodes the queued frames
+in order. When the writer falls behind and every buffer is in use, the
+'drop' policy skips the frame and counts it, so live play never slows down,
+while 'block' waits for the writer, for recordings that must be complete.
+
+Optionally the motion mask is written to a second video next to the first
+(<name>_mask.<ext>), and the game state of every recorded frame goes to a
+JSON lines sidecar (<name>.jsonl) together with its timestamp.
+
+A video container has one fixed frame rate, the game does not: it depends on
+the profile, the quality governor and how busy the effects are. The writer
+thread therefore places every frame by its timestamp, repeating a frame
+until the next one is due and leaving out frames that come faster than the
+container rate, so the video plays back at the speed the game ran at. The
+sidecar notes the first video frame showing every game frame (None when it
+was left out), which keeps the mask video and the sidecar on one timeline.
+'''
+import json, logging, os, threading, time, Queue
+import cv2
+import numpy
+
+DROP = 'drop'
+BLOCK = 'block'
+POLICIES = (DROP, BLOCK)
+
+DEFAULT_FPS = 30
+
+
+def fourcc(code):
+    if hasattr(cv2, 'VideoWriter_fourcc'):
+        return cv2.VideoWriter_fourcc(*code)
+    return cv2.cv.CV_FOURCC(*code)
+
+
+class Recorded(object):
+    __slots__ = ('frame', 'mask', 'index', 'stamp', 'state')
+
+    def __init__(self, width, height, with_mask):
+        self.frame = numpy.empty((height, width, 3), numpy.uint8)
+        self.mask = None
+        if with_mask:
+            self.mask = numpy.empty((height, width), numpy.uint8)
+        self.index = 0
+        self.stamp = 0.0
+        self.state = None
+
+
+class Recorder(object):
+    def __init__(self, path, width, height, fps=DEFAULT_FPS, buffers=30,
+                 policy=DROP, with_mask=False, with_state=True, codec='MJPG'):
+        self.log = logging.getLogger()
+        if policy not in POLICIES:
+            raise ValueError("Unknown recording policy: " + str(policy))
+        self.policy = policy
+        self.path = path
+        self.size = (width, height)
+        self.fps = fps
+
+        root, ext = os.path.splitext(path)
+        self.writer = cv2.VideoWriter(path, fourcc(codec), fps, self.size)
+        if not self.writer.isOpened():
+            raise IOError("Unable to open " + path + " for recording")
+
+        self.mask_writer = None
+        if with_mask:
+            self.mask_writer = cv2.VideoWriter(root + '_mask' + ext,
+                                               fourcc(codec), fps, self.size,
+                                               False)
+        self.state_file = None
+        if with_state:
+            self.state_file = open(root + '.jsonl', 'w')
+
+        self.free = Queue.Queue()
+        # One buffer stays with the writer thread, see run()
+        for idx in range(max(buffers, 2)):
+            self.free.put(Recorded(width, height, with_mask))
+        self.pending = Queue.Queue()
+
+        self.submitted = 0  # Frames offered to the recorder
+        self.written = 0    # Frames encoded by the writer thread
+        self.dropped = 0    # Frames skipped because every buffer was busy
+        self.blocked = 0    # Times the frame loop had to wait for a buffer
+        self.video_frames = 0   # Frames in the container, repeats included
+        self.start = None
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.run, name="Recorder")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, frame, mask=None, state=None):
+        '''
+        Queue a copy of the frame (and mask) for writing. Returns False when
+        the frame was dropped. Nothing is queued once the recorder is closed,
+        the writer thread would never hand the buffer back.
+        '''
+        if self.closed:
+            return False
+        self.submitted += 1
+        try:
+            item = self.free.get_nowait()
+        except Queue.Empty:
+            if self.policy == DROP:
+                self.dropped += 1
+                return False
+            self.blocked += 1
+            item = self.free.get()
+
+        if frame.ndim == 2:
+            cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR, item.frame)
+        else:
+            numpy.copyto(item.frame, frame)
+        if item.mask is not None and mask is not None:
+            numpy.copyto(item.mask, mask)
+        item.index = self.submitted
+        item.stamp = time.time()
+        item.state = state
+        self.pending.put(item)
+        return True
+
+    def write_video(self, item):
+        self.writer.write(item.frame)
+        if self.mask_writer is not None:
+            self.mask_writer.write(item.mask)
+        self.video_frames += 1
+
+    def run(self):
+        # The last frame written is kept out of the free queue, a gap before
+        # the next frame is filled with it
+        previous = None
+        while True:
+            item = self.pending.get()
+            if item is None:
+                break
+
+            if self.start is None:
+                self.start = item.stamp
+            due = int((item.stamp - self.start) * self.fps)
+            while self.video_frames < due:
+                self.write_video(previous)
+
+            video_frame = None
+            if self.video_frames == due:
+                video_frame = due
+                self.write_video(item)
+
+            if self.state_file is not None:
+                self.state_file.write(json.dumps({'frame' : item.index,
+                                                  'video_frame' : video_frame,
+                                                  'time' : item.stamp,
+                                                  'state' : item.state})
+                                      + '\n')
+            self.written += 1
+            if video_frame is None:
+                self.free.put(item)
+            else:
+                if previous is not None:
+                    self.free.put(previous)
+                previous = item
+
+        if previous is not None:
+            self.free.put(previous)
+
+    def close(self):
+        ''' Write out everything queued and close the files. '''
+        if self.closed: return
+        self.closed = True
+        self.pending.put(None)
+        self.thread.join()
+        self.writer.release()
+        if self.mask_writer is not None:
+            self.mask_writer.release()
+        if self.state_file is not None:
+            self.state_file.close()
+        self.log.info("Recorded " + str(self.written) + " of " +
+                      str(self.submitted) + " frames to " + self.path +
+                      " as " + str(self.video_frames) + " video frames at " +
+                      str(self.fps) + " fps" +
+                      ", dropped " + str(self.dropped) + ", waited " +
+                      str(self.blocked) + " times")
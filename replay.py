@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+'''
+Session record and replay for the Bubbler.
+
+RecordingCapture wraps the camera and saves every frame the game actually
+processes, with its timestamp, to a session file. The operator key presses
+are saved along with the number of the frame they followed, and the random
+seed the game was started with goes in the file header. Encoding runs on a
+background thread. It waits rather than drops, since a replay with holes in
+it would not be a replay.
+
+ReplayCapture reads a session file back through the VideoCapture interface
+and is what video.create_capture returns for "replay:<path>" sources.
+Optional parameters after the path:
+
+    timing=realtime  sleep to reproduce the recorded frame timing (default)
+    timing=fast      hand out frames as fast as they are asked for
+
+Both captures set 'stamp' to the recorded time of the frame they just read.
+The game timers run on these stamps rather than on the clock (see
+frameclock.py), so a replay starts the game, grabs the reference and ends the
+game on the same frames as the recording, whatever the replay timing.
+
+Frames are stored as JPEG at quality 95 by default, or losslessly as PNG
+(format='png'), which is several times larger and slower to encode.
+
+File layout: a magic line, one line of JSON header (seed, frame size, image
+format), then records of kind (1 byte: F frame, K key), timestamp (double,
+seconds since the start) and payload length (uint32) followed by the payload:
+the encoded image for frames, the frame number and key code for keys.
+'''
+import json, logging, struct, threading, time, Queue
+import cv2
+import numpy
+
+MAGIC = 'BUBBLER-SESSION-1\n'
+RECORD = struct.Struct('<cdI')
+KEY = struct.Struct('<Ii')
+FRAME = 'F'
+KEY_PRESS = 'K'
+
+FORMATS = {
+    'jpg' : ('.jpg', [cv2.IMWRITE_JPEG_QUALITY, 95]),
+    'png' : ('.png', [cv2.IMWRITE_PNG_COMPRESSION, 1]),
+}
+
+
+class SessionWriter(object):
+    def __init__(self, path, seed, format='jpg', queue_size=8):
+        self.log = logging.getLogger()
+        self.path = path
+        self.extension, self.params = FORMATS[format]
+        self.format = format
+        self.seed = seed
+        self.file = open(path, 'wb')
+        self.header_written = False
+        self.start = time.time()
+        self.frames = 0
+
+        self.queue = Queue.Queue(queue_size)
+        self.thread = threading.Thread(target=self.run, name="SessionWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write_header(self, frame):
+        height, width = frame.shape[:2]
+        header = {'seed' : self.seed, 'width' : width, 'height' : height,
+                  'format' : self.format, 'created' : self.start}
+        self.file.write(MAGIC)
+        self.file.write(json.dumps(header) + '\n')
+        self.header_written = True
+
+    def frame(self, img):
+        ''' Queue the frame for encoding and return its time stamp. '''
+        stamp = time.time() - self.start
+        # The caller may reuse its buffer (the capture ring does)
+        self.queue.put((FRAME, stamp, img.copy()))
+        self.frames += 1
+        return stamp
+
+    def key(self, key):
+        ''' Note a key pressed after the latest frame was processed. '''
+        self.queue.put((KEY_PRESS, time.time() - self.start,
+                        (self.frames, key)))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            kind, stamp, data = item
+            if kind == FRAME:
+                if not self.header_written:
+                    self.write_header(data)
+                ret, encoded = cv2.imencode(self.extension, data, self.params)
+                payload = encoded.tostring()
+            else:
+                payload = KEY.pack(*data)
+            self.file.write(RECORD.pack(kind, stamp, len(payload)))
+            self.file.write(payload)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        self.log.info("Recorded " + str(self.frames) + " session frames to " +
+                      self.path)
+
+
+class RecordingCapture(object):
+    ''' Pass reads through to the wrapped capture, saving every frame. '''
+    def __init__(self, cam, writer):
+        self.cam = cam
+        self.writer = writer
+        self.stamp = None
+
+    def read(self, dst=None):
+        ret, img = self.cam.read()
+        if ret:
+            self.stamp = self.writer.frame(img)
+            if dst is not None:
+                numpy.copyto(dst, img)
+                img = dst
+        return ret, img
+
+    def __getattr__(self, name):
+        return getattr(self.cam, name)
+
+
+class ReplayCapture(object):
+    def __init__(self, path, timing='realtime'):
+        self.log = logging.getLogger()
+        self.path = path
+        self.realtime = (timing == 'realtime')
+        self.file = open(path, 'rb')
+        if self.file.readline() != MAGIC:
+            raise IOError(path + " is not a Bubbler session")
+        self.header = json.loads(self.file.readline())
+        self.seed = self.header.get('seed')
+
+        self.frames = 0
+        self.keys = {}
+        self.start = None
+        self.stamp = None
+        self.upcoming = self.next_record()
+
+    def next_record(self):
+        head = self.file.read(RECORD.size)
+        if len(head) < RECORD.size:
+            return None
+        kind, stamp, length = RECORD.unpack(head)
+        return kind, stamp, self.file.read(length)
+
+    def read(self, dst=None):
+        record = self.upcoming
+        if record is None:
+            return False, None
+        kind, stamp, payload = record
+
+        # Keys pressed after this frame are known before it is handed out
+        self.upcoming = self.next_record()
+        while self.upcoming is not None and self.upcoming[0] == KEY_PRESS:
+            frame_number, key = KEY.unpack(self.upcoming[2])
+            self.keys.setdefault(frame_number, []).append(key)
+            self.upcoming = self.next_record()
+
+        if self.realtime:
+            now = time.time()
+            if self.start is None:
+                self.start = now - stamp
+            delay = self.start + stamp - now
+            if delay > 0:
+                time.sleep(delay)
+
+        img = cv2.imdecode(numpy.frombuffer(payload, numpy.uint8), 1)
+        self.frames += 1
+        self.stamp = stamp
+        if dst is not None:
+            numpy.copyto(dst, img)
+            img = dst
+        return True, img
+
+    def keys_after(self, frame_number=None):
+        '''
+        Keys the operator pressed after the given frame (by default the
+        latest one read) was processed.
+        '''
+        if frame_number is None:
+            frame_number = self.frames
+        return self.keys.pop(frame_number, [])
+
+    def isOpened(self):
+        return not self.file.closed
+
+    def release(self):
+        self.file.close()
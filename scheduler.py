@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+'''
+Ordered effect stages for the Bubbler frame loop.
+
+Every frame runs three stages in order: pre (change the frame or the motion
+mask), game (collisions and moving actors) and post (overlays). The stages
+used to be Queue.Queue objects that were drained and refilled on every frame.
+EffectScheduler keeps one list per stage, sorted by priority and then by the
+order effects were added, and iterates it in place.
+
+Effects keep the flags they always had. An effect whose 'preproc_enabled'
+(pre stage) or 'enabled' (game and post stages) flag is False after it ran is
+dropped from that stage, so setting the flag is still how an effect retires
+itself. Removal is a constant time mark, and the list is compacted after the
+stage has run. Effects added while a stage is running start on the next frame.
+An effect that raises is logged and dropped without stopping the rest of its
+stage. When a profiler is attached, every effect call is timed as
+"<stage>:<class name>".
+'''
+import bisect, itertools, logging, traceback
+
+from common import clock
+
+PRE  = 'pre'
+GAME = 'game'
+POST = 'post'
+STAGES = (PRE, GAME, POST)
+
+ENABLE_FLAGS = {
+    PRE  : 'preproc_enabled',
+    GAME : 'enabled',
+    POST : 'enabled',
+}
+
+
+class Entry(object):
+    __slots__ = ('effect', 'priority', 'order', 'alive', 'active')
+
+    def __init__(self, effect, priority, order):
+        self.effect = effect
+        self.priority = priority
+        self.order = order
+        self.alive = True
+        self.active = True
+
+    def sort_key(self):
+        return (self.priority, self.order)
+
+
+class EffectScheduler(object):
+    def __init__(self):
+        self.log = logging.getLogger()
+        self.stages = dict((stage, []) for stage in STAGES)
+        self.keys = dict((stage, []) for stage in STAGES)
+        self.entries = {}
+        self.pending = []
+        self.running = None
+        self.dead = dict((stage, 0) for stage in STAGES)
+        self.counter = itertools.count()
+        self.profiler = None
+
+    def add(self, stage, effect, priority=0):
+        '''
+        Schedule the effect in the stage. Adding an effect that is already
+        scheduled in that stage does nothing, so callers can re-add freely.
+        '''
+        key = (stage, id(effect))
+        if key in self.entries:
+            return
+
+        entry = Entry(effect, priority, next(self.counter))
+        self.entries[key] = entry
+        if stage == self.running:
+            self.pending.append((stage, entry))
+        else:
+            self.insert(stage, entry)
+
+    def insert(self, stage, entry):
+        sort_key = entry.sort_key()
+        idx = bisect.bisect_right(self.keys[stage], sort_key)
+        self.keys[stage].insert(idx, sort_key)
+        self.stages[stage].insert(idx, entry)
+
+    def remove(self, stage, effect):
+        entry = self.entries.pop((stage, id(effect)), None)
+        if entry is not None:
+            entry.alive = False
+            self.dead[stage] += 1
+
+    def set_active(self, stage, effect, active):
+        ''' Pause or resume an effect without giving up its place. '''
+        entry = self.entries.get((stage, id(effect)))
+        if entry is not None:
+            entry.active = active
+
+    def contains(self, stage, effect):
+        return (stage, id(effect)) in self.entries
+
+    def effects(self, stage):
+        return [entry.effect for entry in self.stages[stage] if entry.alive]
+
+    def clear(self, stage):
+        for entry in self.stages[stage]:
+            if entry.alive:
+                self.remove(stage, entry.effect)
+
+        # Effects added while the stage was running are not in its list yet
+        for pending_stage, entry in self.pending:
+            if pending_stage == stage and entry.alive:
+                self.entries.pop((stage, id(entry.effect)), None)
+                entry.alive = False
+        self.pending = [(s, e) for s, e in self.pending if s != stage]
+
+    def compact(self, stage):
+        if self.dead[stage]:
+            entries = [entry for entry in self.stages[stage] if entry.alive]
+            self.stages[stage] = entries
+            self.keys[stage] = [entry.sort_key() for entry in entries]
+            self.dead[stage] = 0
+
+    def run(self, stage, handler):
+        '''
+        Call handler(effect) for every live effect in the stage, in priority
+        order.
+        '''
+        flag = ENABLE_FLAGS[stage]
+        self.running = stage
+        try:
+            for entry in self.stages[stage]:
+                if not entry.alive or not entry.active:
+                    continue
+
+                effect = entry.effect
+                start = clock()
+                try:
+                    handler(effect)
+                except Exception:
+                    self.log.critical(stage.upper() + " " +
+                                      effect.__class__.__name__ + ": " +
+                                      traceback.format_exc())
+                    self.remove(stage, effect)
+                    continue
+                finally:
+                    if self.profiler is not None:
+                        self.profiler.add(stage + ':' +
+                                          effect.__class__.__name__,
+                                          clock() - start)
+
+                if not getattr(effect, flag, True):
+                    self.remove(stage, effect)
+        finally:
+            self.running = None
+
+        self.compact(stage)
+
+        pending, self.pending = self.pending, []
+        for pending_stage, entry in pending:
+            if entry.alive:
+                self.insert(pending_stage, entry)
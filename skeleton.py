@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+'''
+Skeletonization of the motion mask for SkeletonBubble.
+
+SkeletonEngine keeps every intermediate image between frames and writes them
+with dst= outputs, swapping the erode buffers instead of copying them. It
+only counts the remaining pixels every few passes. Two methods are available:
+
+    morph    - the morphological skeleton (erode, dilate, subtract, or) the
+               effect has always used, based on:
+               http://opencvpython.blogspot.com/2012/05/\
+                       skeletonization-using-opencv-python.html
+    thinning - Zhang-Suen thinning, through cv2.ximgproc when the contrib
+               modules are installed, otherwise a table driven version built
+               on filter2D and LUT.
+               Thinner, connected lines.
+
+With budget_ms set, skeletonize() stops working once the frame's time budget
+is spent and picks the same skeleton up again on the next frame. Until the new
+skeleton is finished the last complete one is shown, so the frame never stalls
+on a big blob. It may be a few frames old.
+'''
+import cv2
+import numpy
+
+from common import clock
+
+MORPH = 'morph'
+THINNING = 'thinning'
+
+
+# Weights that give each of the eight neighbors its own bit, in the Zhang-Suen
+# order P2 (north) clockwise to P9 (north west). filter2D correlates, so the
+# kernel is laid out as the neighborhood itself.
+NEIGHBOR_BITS = numpy.array([[128,  1,  2],
+                             [ 64,  0,  4],
+                             [ 32, 16,  8]], numpy.float32)
+
+def zhang_suen_tables():
+    '''
+    Lookup tables from neighborhood code to "remove this pixel" for the two
+    Zhang-Suen sub-iterations.
+    '''
+    tables = []
+    for first in (True, False):
+        table = numpy.zeros((256,), numpy.uint8)
+        for code in range(256):
+            p = [(code >> bit) & 1 for bit in range(8)]
+            p2, p3, p4, p5, p6, p7, p8, p9 = p
+            neighbors = sum(p)
+            ring = p + [p2]
+            transitions = sum(1 for a, b in zip(ring[:-1], ring[1:])
+                              if a == 0 and b == 1)
+            if first:
+                keep = p2 * p4 * p6 or p4 * p6 * p8
+            else:
+                keep = p2 * p4 * p8 or p2 * p6 * p8
+            if 2 <= neighbors <= 6 and transitions == 1 and not keep:
+                table[code] = 1
+        tables.append(table)
+    return tables
+
+ZHANG_SUEN_TABLES = zhang_suen_tables()
+
+
+def zhang_suen_pass(img, code, remove):
+    '''
+    One Zhang-Suen iteration (both sub-iterations) on a 0/1 uint8 image, in
+    place, using code and remove as scratch images. Returns the number of
+    pixels removed.
+    '''
+    removed = 0
+    for table in ZHANG_SUEN_TABLES:
+        cv2.filter2D(img, -1, NEIGHBOR_BITS, code,
+                     borderType=cv2.BORDER_CONSTANT)
+        cv2.LUT(code, table, remove)
+        cv2.bitwise_and(remove, img, remove)
+        count = cv2.countNonZero(remove)
+        if count:
+            cv2.subtract(img, remove, img)
+            removed += count
+    return removed
+
+
+class SkeletonEngine(object):
+    def __init__(self, method=MORPH, max_passes=100, check_every=4,
+                 budget_ms=None):
+        self.method = method
+        self.max_passes = max_passes
+        self.check_every = check_every
+        self.budget_ms = budget_ms
+        self.element = cv2.getStructuringElement(cv2.MORPH_CROSS, (3, 3))
+        self.use_ximgproc = (method == THINNING and
+                             hasattr(cv2, 'ximgproc') and
+                             hasattr(cv2.ximgproc, 'thinning'))
+        self.shape = None
+        self.working = False
+        self.have_result = False
+
+    def allocate(self, shape):
+        if self.shape == shape: return
+        self.shape = shape
+        self.img = numpy.empty(shape, numpy.uint8)
+        self.eroded = numpy.empty(shape, numpy.uint8)
+        self.temp = numpy.empty(shape, numpy.uint8)
+        self.skel = numpy.empty(shape, numpy.uint8)
+        self.result = numpy.zeros(shape, numpy.uint8)
+        self.output = numpy.empty(shape, numpy.uint8)
+        self.working = False
+        self.have_result = False
+
+    def begin(self, mask):
+        self.allocate(mask.shape[:2])
+        if self.method == THINNING and not self.use_ximgproc:
+            cv2.threshold(mask, 127, 1, cv2.THRESH_BINARY, self.img)
+        else:
+            cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY, self.img)
+        self.skel.fill(0)
+        self.passes = 0
+        self.working = True
+
+    def morph_pass(self):
+        img, eroded, temp = self.img, self.eroded, self.temp
+        cv2.erode(img, self.element, eroded)
+        cv2.dilate(eroded, self.element, temp)
+        cv2.subtract(img, temp, temp)
+        cv2.bitwise_or(self.skel, temp, self.skel)
+
+        # The eroded image is the input to the next pass, swap instead of copy
+        self.img, self.eroded = eroded, img
+        self.passes += 1
+
+        if self.passes % self.check_every == 0:
+            return cv2.countNonZero(self.img) == 0
+        return False
+
+    def thinning_pass(self):
+        if self.use_ximgproc:
+            cv2.ximgproc.thinning(self.img, self.skel)
+            return True
+
+        self.passes += 1
+        removed = zhang_suen_pass(self.img, self.eroded, self.temp)
+        if removed == 0:
+            cv2.multiply(self.img, 255, self.skel)
+            return True
+        return False
+
+    def step(self):
+        if self.method == THINNING:
+            done = self.thinning_pass()
+        else:
+            done = self.morph_pass()
+
+        if not done and self.passes >= self.max_passes:
+            # Out of passes, take what is there so far
+            if self.method == THINNING and not self.use_ximgproc:
+                cv2.multiply(self.img, 255, self.skel)
+            done = True
+        return done
+
+    def finish(self):
+        self.skel, self.result = self.result, self.skel
+        self.have_result = True
+        self.working = False
+
+    def skeletonize(self, mask):
+        '''
+        Return the skeleton of the mask. In budget mode this is the newest
+        complete skeleton. The returned image belongs to the engine and is
+        overwritten on the next call.
+        '''
+        if self.budget_ms is None:
+            self.begin(mask)
+            while not self.step():
+                pass
+            self.finish()
+
+        else:
+            if not self.working:
+                self.begin(mask)
+            deadline = clock() + self.budget_ms / 1000.0
+            while True:
+                if self.step():
+                    self.finish()
+                    break
+                if clock() > deadline:
+                    break
+        return self.latest()
+
+    def latest(self):
+        '''
+        A fresh copy of the newest skeleton without doing any work, for
+        frames where the mask has not changed.
+        '''
+        if self.shape is None:
+            return None
+        if self.have_result:
+            numpy.copyto(self.output, self.result)
+        elif self.method == THINNING and not self.use_ximgproc:
+            cv2.multiply(self.img, 255, self.output)
+        else:
+            numpy.copyto(self.output, self.skel)
+        return self.output
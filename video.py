@@ -18,10 +18,18 @@ Usage:
      - integer number for camera capture
      - name of video file
      - synth:<params> for procedural video
+     - replay:<path>[:timing=realtime|fast] for a recorded Bubbler session
+       (see replay.py)
 
 Synth examples:
     synth:bg=../cpp/lena.jpg:noise=0.1
     synth:class=chess:bg=../cpp/lena.jpg:noise=0.1:size=640x480
+    synth:class=blobs:count=5:speed=6:noise=0.05:size=800x600
+
+Synthetic sources reuse one output buffer (the frame returned by read() is
+overwritten by the next call unless a dst is passed in) and add noise from a
+bank of noise_frames precomputed noise images instead of generating new noise
+every frame.
 
 Keys:
     ESC    - exit
@@ -36,7 +44,8 @@ from numpy import pi, sin, cos
 import common
 
 class VideoSynthBase(object):
-    def __init__(self, size=None, noise=0.0, bg = None, **params):
+    def __init__(self, size=None, noise=0.0, bg = None, noise_frames=16,
+                 **params):
         self.bg = None
         self.frame_size = (640, 480)
         if bg is not None:
@@ -47,27 +56,47 @@ class VideoSynthBase(object):
         if size is not None:
             w, h = map(int, size.split('x'))
             self.frame_size = (w, h)
-            self.bg = cv2.resize(self.bg, self.frame_size)
+            if self.bg is not None:
+                self.bg = cv2.resize(self.bg, self.frame_size)
 
         self.noise = float(noise)
+        self.noise_frames = int(noise_frames)
+        self.noise_bank = []
+        self.noise_index = 0
+        self.buf = None
 
     def render(self, dst):
         pass
 
+    def next_noise(self):
+        w, h = self.frame_size
+        if not self.noise_bank:
+            for i in range(self.noise_frames):
+                noise = np.zeros((h, w, 3), np.int8)
+                cv2.randn(noise, np.zeros(3), np.ones(3)*255*self.noise)
+                self.noise_bank.append(noise)
+        noise = self.noise_bank[self.noise_index]
+        self.noise_index = (self.noise_index + 1) % len(self.noise_bank)
+        return noise
+
     def read(self, dst=None):
         w, h = self.frame_size
 
+        buf = dst
+        if buf is None or buf.shape != (h, w, 3) or buf.dtype != np.uint8:
+            if self.buf is None:
+                self.buf = np.empty((h, w, 3), np.uint8)
+            buf = self.buf
+
         if self.bg is None:
-            buf = np.zeros((h, w, 3), np.uint8)
+            buf.fill(0)
         else:
-            buf = self.bg.copy()
+            np.copyto(buf, self.bg)
 
         self.render(buf)
 
         if self.noise > 0.0:
-            noise = np.zeros((h, w, 3), np.int8)
-            cv2.randn(noise, np.zeros(3), np.ones(3)*255*self.noise)
-            buf = cv2.add(buf, noise, dtype=cv2.CV_8UC3)
+            cv2.add(buf, self.next_noise(), buf, dtype=cv2.CV_8UC3)
         return True, buf
 
     def isOpened(self):
@@ -88,6 +117,10 @@ class Chess(VideoSynthBase):
         self.white_quads = np.float32(white_quads)
         self.black_quads = np.float32(black_quads)
 
+        # Every corner of the board is projected in a single call
+        self.all_quads = np.concatenate([self.white_quads, self.black_quads])
+        self.white_count = len(self.white_quads)
+
         fx = 0.9
         self.K = np.float64([[fx*w, 0, 0.5*(w-1)],
                         [0, fx*w, 0.5*(h-1)],
@@ -96,11 +129,10 @@ class Chess(VideoSynthBase):
         self.dist_coef = np.float64([-0.2, 0.1, 0, 0])
         self.t = 0
 
-    def draw_quads(self, img, quads, color = (0, 255, 0)):
+    def project_quads(self, quads):
+        ''' Image corners of the quads, in fixed point with 2 fraction bits '''
         img_quads = cv2.projectPoints(quads.reshape(-1, 3), self.rvec, self.tvec, self.K, self.dist_coef) [0]
-        img_quads.shape = quads.shape[:2] + (2,)
-        for q in img_quads:
-            cv2.fillConvexPoly(img, np.int32(q*4), color, cv2.CV_AA, shift=2)
+        return np.int32(img_quads.reshape(quads.shape[:2] + (2,)) * 4)
 
     def render(self, dst):
         t = self.t
@@ -117,11 +149,65 @@ class Chess(VideoSynthBase):
         R, self.tvec = common.lookat(eye_pos, target_pos)
         self.rvec = common.mtx2rvec(R)
 
-        self.draw_quads(dst, self.white_quads, (245, 245, 245))
-        self.draw_quads(dst, self.black_quads, (10, 10, 10))
+        # Same colored squares only touch at their corners, so each color is
+        # one fillPoly call
+        img_quads = self.project_quads(self.all_quads)
+        n = self.white_count
+        cv2.fillPoly(dst, list(img_quads[:n]), (245, 245, 245), cv2.CV_AA,
+                     shift=2)
+        cv2.fillPoly(dst, list(img_quads[n:]), (10, 10, 10), cv2.CV_AA,
+                     shift=2)
 
 
-classes = dict(chess=Chess)
+class MovingBlobs(VideoSynthBase):
+    '''
+    Actors walking across a still room: count figures (a body and a head)
+    crossing the frame at around speed pixels per frame, each at its own
+    pace and direction, and coming back in from the other side. The room is
+    the bg image if one is given, otherwise a fixed texture, so the first
+    frames make a good reference image.
+    '''
+    def __init__(self, count=3, speed=4, seed=0, **kw):
+        super(MovingBlobs, self).__init__(**kw)
+        w, h = self.frame_size
+        count = int(count)
+        speed = float(speed)
+        rng = np.random.RandomState(int(seed))
+
+        if self.bg is None:
+            texture = rng.randint(40, 200, (h // 16 + 1, w // 16 + 1, 3))
+            self.bg = cv2.resize(np.uint8(texture), (w, h),
+                                 interpolation=cv2.INTER_LINEAR)
+
+        self.size = rng.uniform(0.7, 1.3, count) * h / 5
+        self.x = rng.uniform(0, w, count)
+        self.y = h - self.size * rng.uniform(0.9, 1.6, count)
+        self.dx = (rng.uniform(0.5, 1.5, count) * speed *
+                   rng.choice([-1, 1], count))
+        self.colors = [tuple(int(c) for c in color)
+                       for color in rng.randint(0, 256, (count, 3))]
+        self.t = 0
+
+    def render(self, dst):
+        w, h = self.frame_size
+        self.t += 1
+
+        # Walk, wrapping around once fully off screen
+        self.x += self.dx
+        margin = self.size
+        self.x = np.where(self.x > w + margin, -margin, self.x)
+        self.x = np.where(self.x < -margin, w + margin, self.x)
+        bob = np.abs(np.sin(self.t * 0.3 + self.x * 0.05)) * self.size * 0.05
+
+        for x, y, size, color in zip(np.int32(self.x), np.int32(self.y - bob),
+                                     np.int32(self.size), self.colors):
+            cv2.ellipse(dst, (x, y), (size // 4, size // 2), 0, 0, 360,
+                        color, -1, cv2.CV_AA)
+            cv2.circle(dst, (x, y - size * 3 // 4), size // 6, color, -1,
+                       cv2.CV_AA)
+
+
+classes = dict(chess=Chess, blobs=MovingBlobs)
 
 presets = dict(
     empty = 'synth:',
@@ -140,6 +226,15 @@ def create_capture(source = 0, fallback = presets['chess']):
         chunks[1] = chunks[0] + ':' + chunks[1]
         del chunks[0]
 
+    # The session path may itself have a drive letter
+    if chunks[0] == 'replay':
+        if len(chunks) > 2 and len(chunks[1]) == 1 and chunks[1].isalpha():
+            chunks[1] = chunks[1] + ':' + chunks[2]
+            del chunks[2]
+        import replay
+        params = dict( s.split('=') for s in chunks[2:] )
+        return replay.ReplayCapture(chunks[1], **params)
+
     source = chunks[0]
     try: source = int(source)
     except ValueError: pass
@@ -156,6 +251,8 @@ def create_capture(source = 0, fallback = presets['chess']):
             w, h = map(int, params['size'].split('x'))
             cap.set(cv2.cv.CV_CAP_PROP_FRAME_WIDTH, w)
             cap.set(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT, h)
+        if 'fps' in params:
+            cap.set(cv2.cv.CV_CAP_PROP_FPS, float(params['fps']))
     if cap is None or not cap.isOpened():
         print 'Warning: unable to open video source: ', source
         if fallback is not None: